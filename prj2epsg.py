@@ -1,38 +1,488 @@
 #!/usr/bin/python3.6
 
+import os
+import re
 import sys
+import gzip
+import json
+import sqlite3
+import hashlib
+import functools
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    import requests
+    import numpy
 except ImportError as err_import:
-    print("Erreur à l'import de requests")
+    print("Erreur à l'import de numpy")
     print(err_import)
     sys.exit(1)
 
+# index local WKT -> EPSG, généré par --build-index à partir de la base
+# EPSG de pyproj (WKT ESRI et GDAL de chaque CRS projeté ou géographique)
+INDEX_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "prj2epsg_index.json.gz")
+
+PRJ2EPSG_URL = "http://prj2epsg.org/search.json"
+# cache des réponses de prj2epsg.org
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "prj2epsg.sqlite")
+
+# noeuds WKT sans effet sur la correspondance
+IGNORED_NODES = {"AUTHORITY", "AXIS", "TOWGS84", "EXTENSION"}
+# noeuds dont le nom est conservé (normalisé), les autres noms varient trop
+NAMED_NODES = {"DATUM", "PROJECTION", "PARAMETER"}
+
+# tolérance relative de la comparaison approchée des paramètres
+TOLERANCE = 1e-7
+
+_index = None
+_groups = None
+_client = None
+
+
 def main():
-    print(prj2epsg(sys.argv[1]))
+    parser = argparse.ArgumentParser(description="Code EPSG de fichiers .prj")
+    parser.add_argument("prj", nargs="*", help="fichiers .prj")
+    parser.add_argument(
+        "--online",
+        action="store_true",
+        help="interroger prj2epsg.org pour les .prj sans correspondance dans l'index local"
+    )
+    parser.add_argument("--url", default=PRJ2EPSG_URL, help="url du service prj2epsg")
+    parser.add_argument(
+        "--cache",
+        default=CACHE_FILE,
+        help="base sqlite des réponses du service (défaut: {0})".format(CACHE_FILE)
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="nombre maximal de requêtes simultanées au service"
+    )
+    parser.add_argument("--timeout", type=float, default=10, help="timeout des requêtes (s)")
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        help="regénérer l'index local à partir de la base EPSG de pyproj"
+    )
+    args = parser.parse_args()
+
+    if args.build_index:
+        print(build_index(), "CRS indexés dans", INDEX_FILE)
+    elif len(args.prj) == 1 and not args.online:
+        print(prj2epsg(args.prj[0]))
+    elif args.prj:
+        client = None
+        if args.online:
+            try:
+                client = Prj2EpsgClient(args.url, args.cache, args.timeout, args.jobs)
+            except ImportError as err_import:
+                print(err_import)
+                sys.exit(1)
+        for prjfile, epsg in prj2epsg_files(args.prj, client).items():
+            print(prjfile, epsg)
+        if client is not None:
+            client.close()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
 
-def prj2epsg(prjfile):
+def read_prj(prjfile):
     try:
         with open(prjfile, mode="r", encoding="utf-8") as prj:
-            r = requests.get(
-                "http://prj2epsg.org/search.json", 
-                params={"mode": "wkt", "terms": prj.read()}
+            return prj.read()
+    except Exception as e:
+        print("prj2epsg() ERREUR: ", e)
+        return None
+
+
+def prj2epsg(prjfile, online=False):
+    """Code EPSG du .prj par l'index local, puis par prj2epsg.org si
+       online et pas de correspondance locale. None si aucun ne répond
+       (service injoignable ou requests absent)
+    """
+    wkt = read_prj(prjfile)
+    if wkt is None:
+        return None
+
+    epsg = match_wkt(wkt)
+    if epsg is None and online:
+        try:
+            epsg = default_client().lookup(wkt)
+        except ImportError as err_import:
+            print("prj2epsg() ERREUR: ", err_import)
+    return epsg
+
+
+def prj2epsg_files(prjfiles, client=None):
+    """Codes EPSG d'une liste de .prj ({fichier: code}) : index local, puis
+       requêtes simultanées de client (Prj2EpsgClient) pour les autres
+    """
+    wkts = {prjfile: read_prj(prjfile) for prjfile in prjfiles}
+    codes = {
+        prjfile: match_wkt(wkt) if wkt is not None else None
+        for prjfile, wkt in wkts.items()
+    }
+    unresolved = [
+        prjfile for prjfile, epsg in codes.items()
+        if epsg is None and wkts[prjfile] is not None
+    ]
+    if client is not None and unresolved:
+        remote = client.lookup_many([wkts[prjfile] for prjfile in unresolved])
+        codes.update(zip(unresolved, remote))
+    return codes
+
+
+class Prj2EpsgClient:
+    """
+    Client du service prj2epsg :
+    - une session requests (connexions réutilisées, pool de jobs connexions)
+      et un timeout sur chaque requête
+    - cache sqlite persistant des réponses, clé = sha256 du contenu du WKT.
+      Les WKT sans correspondance exacte sont aussi mis en cache, pas les
+      erreurs (réseau, statut HTTP)
+    - lookup_many() n'envoie qu'une requête par WKT distinct absent du cache,
+      au plus jobs à la fois
+    url peut pointer vers un serveur local de même API pour les tests
+    """
+
+    def __init__(self, url=PRJ2EPSG_URL, cachefn=CACHE_FILE, timeout=10, jobs=8):
+        self.url = url
+        self.timeout = timeout
+        self.jobs = jobs
+        # requests n'est importé que pour le service en ligne : la
+        # correspondance locale fonctionne sans. ImportError remontée à
+        # l'appelant, qui peut se passer du service
+        try:
+            import requests
+        except ImportError as err_import:
+            raise ImportError(
+                "requests est nécessaire pour interroger le service prj2epsg"
+            ) from err_import
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        if cachefn != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cachefn)), exist_ok=True)
+        self.cache = sqlite3.connect(cachefn)
+        self.cache.execute(
+            "CREATE TABLE IF NOT EXISTS codes (cle TEXT PRIMARY KEY, epsg TEXT)"
+        )
+        self.stats = {"cache": 0, "requetes": 0, "erreurs": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def key(wkt):
+        return hashlib.sha256(wkt.strip().encode("utf-8")).hexdigest()
+
+    def request(self, wkt):
+        """Requête au service. Retourne (réponse valide, code EPSG ou None)"""
+        try:
+            r = self.session.get(
+                self.url, params={"mode": "wkt", "terms": wkt}, timeout=self.timeout
             )
             if r.status_code == 200:
                 resp = r.json()
                 if resp["exact"]:
-                    epsg = resp["codes"][0]["code"]
-                    return epsg
+                    return True, resp["codes"][0]["code"]
                 else:
                     print("prj2epsg() pas de match exact")
-                    return None
+                    return True, None
             else:
                 print("prj2epsg() ERREUR : status_code", r.status_code)
-                return None
-    except Exception as e:
-        print("prj2epsg() ERREUR: ", e)
+                return False, None
+        except Exception as e:
+            print("prj2epsg() ERREUR: ", e)
+            return False, None
+
+    def lookup_many(self, wkts):
+        """Codes EPSG (ou None) de wkts, dans l'ordre"""
+        keys = [self.key(wkt) for wkt in wkts]
+        unique = dict(zip(keys, wkts))
+        codes = {}
+        for key in unique:
+            row = self.cache.execute("SELECT epsg FROM codes WHERE cle = ?", (key,)).fetchone()
+            if row is not None:
+                codes[key] = row[0]
+                self.stats["cache"] += 1
+
+        misses = [key for key in unique if key not in codes]
+        with ThreadPoolExecutor(max(1, min(self.jobs, len(misses)))) as executor:
+            responses = executor.map(self.request, [unique[key] for key in misses])
+            for key, (valid, epsg) in zip(misses, responses):
+                self.stats["requetes"] += 1
+                codes[key] = epsg
+                if valid:
+                    self.cache.execute("INSERT OR REPLACE INTO codes VALUES (?, ?)", (key, epsg))
+                else:
+                    self.stats["erreurs"] += 1
+        self.cache.commit()
+        return [codes[key] for key in keys]
+
+    def lookup(self, wkt):
+        return self.lookup_many([wkt])[0]
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+
+def default_client():
+    """Client partagé créé au premier appel en ligne de prj2epsg()"""
+    global _client
+    if _client is None:
+        _client = Prj2EpsgClient()
+    return _client
+
+
+def parse_wkt(wkt):
+    """Arbre d'un WKT1 : [MOT_CLE, arg, ...] où arg est une chaîne, un
+       nombre ou un noeud. Lève ValueError si le WKT est mal formé
+    """
+    tokens = re.findall(r'"(?:[^"]|"")*"|[\[\](),]|[^\s\[\](),"]+', wkt)
+    position = 0
+
+    def node():
+        nonlocal position
+        keyword = tokens[position]
+        position += 1
+        if position == len(tokens) or tokens[position] not in "[(":
+            return keyword
+        position += 1
+        args = []
+        while tokens[position] not in "])":
+            token = tokens[position]
+            if token.startswith('"'):
+                args.append(token[1:-1].replace('""', '"'))
+                position += 1
+            else:
+                try:
+                    args.append(float(token))
+                    position += 1
+                except ValueError:
+                    args.append(node())
+            if tokens[position] == ",":
+                position += 1
+        position += 1
+        return [keyword.upper()] + args
+
+    try:
+        tree = node()
+    except IndexError:
+        raise ValueError("WKT incomplet")
+    # un WKT ESRI peut être suivi d'un VERTCS, seul le premier noeud compte
+    if not isinstance(tree, list) or (position != len(tokens) and tokens[position] != ","):
+        raise ValueError("WKT mal formé")
+    return tree
+
+
+def normalize_name(name):
+    """Nom en minuscules sans séparateurs, sans le préfixe D_ des datums ESRI"""
+    if name.upper().startswith("D_"):
+        name = name[2:]
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def normalize(tree):
+    """Forme canonique d'un arbre WKT : noeuds sans effet retirés, noms
+       normalisés (ou retirés), nombres arrondis à 9 chiffres significatifs,
+       paramètres triés par nom
+    """
+    keyword, args = tree[0], tree[1:]
+    result = [keyword]
+    if args and isinstance(args[0], str):
+        result.append(normalize_name(args[0]) if keyword in NAMED_NODES else "")
+        args = args[1:]
+    children = []
+    for arg in args:
+        if isinstance(arg, float):
+            result.append(float("%.9g" % arg))
+        elif isinstance(arg, list) and arg[0] not in IGNORED_NODES:
+            children.append(normalize(arg))
+    parameters = sorted(child for child in children if child[0] == "PARAMETER")
+    return result + [child for child in children if child[0] != "PARAMETER"] + parameters
+
+
+def wkt_hash(canonical):
+    """Hash (64 bits en hexadécimal) de la forme canonique"""
+    return hashlib.sha1(json.dumps(canonical, separators=(",", ":")).encode()).hexdigest()[:16]
+
+
+def signature(canonical):
+    """Caractéristiques comparées par la recherche approchée :
+       (type, méthode sans suffixe 1SP/2SP, datum, ellipsoïde, paramètres)
+    """
+    nodes = {}
+    parameters = {}
+
+    def walk(node):
+        for child in node[2:]:
+            if isinstance(child, list):
+                if child[0] == "PARAMETER":
+                    parameters[child[1]] = child[2] if len(child) > 2 else 0.0
+                else:
+                    nodes.setdefault(child[0], child)
+                walk(child)
+
+    walk(canonical)
+    method = nodes.get("PROJECTION", ["", ""])[1]
+    method = re.sub(r"[12]sp$", "", method)
+    spheroid = tuple(value for value in nodes.get("SPHEROID", [])[2:] if isinstance(value, float))
+    datum = nodes.get("DATUM", ["", ""])[1]
+    return canonical[0], method, datum, spheroid, parameters
+
+
+def load_index():
+    """Index chargé une seule fois : hash de la forme canonique -> liste
+       des (nom normalisé, code EPSG) des CRS de même définition
+    """
+    global _index
+    if _index is None and not os.path.exists(INDEX_FILE):
+        print("load_index() index absent, le générer avec --build-index:", INDEX_FILE)
+        _index = {}, []
+    if _index is None:
+        with gzip.open(INDEX_FILE, "rt", encoding="utf-8") as index_file:
+            entries = json.load(index_file)
+        hashes = {}
+        for code, name, digest, canonical in entries:
+            hashes.setdefault(digest, []).append((name, code))
+        _index = hashes, entries
+    return _index
+
+
+def load_groups():
+    """Signatures de l'index groupées par (type, méthode, demi grand axe
+       arrondi au mètre), construites à la première recherche approchée.
+       Chaque groupe : codes, datums, tableau numpy des ellipsoïdes, noms des
+       paramètres et tableau numpy des valeurs (0 si paramètre absent)
+    """
+    global _groups
+    if _groups is None:
+        signatures = {}
+        for code, name, digest, canonical in load_index()[1]:
+            sig = signature(canonical)
+            signatures.setdefault(group_key(sig), []).append((code, sig))
+        _groups = {}
+        for key, members in signatures.items():
+            names = sorted({parameter for code, sig in members for parameter in sig[4]})
+            _groups[key] = (
+                [code for code, sig in members],
+                [sig[2] for code, sig in members],
+                numpy.array([spheroid_values(sig[3]) for code, sig in members]),
+                names,
+                numpy.array(
+                    [[sig[4].get(parameter, 0.0) for parameter in names] for code, sig in members]
+                ).reshape(len(members), len(names)),
+            )
+    return _groups
+
+
+def group_key(sig):
+    kind, method, datum, spheroid, parameters = sig
+    return kind, method, round(spheroid[0]) if spheroid else None
+
+
+def spheroid_values(spheroid):
+    """(demi grand axe, aplatissement inverse), 0 si absents"""
+    return (tuple(spheroid) + (0.0, 0.0))[:2]
+
+
+def close(a, b):
+    """Égalité à TOLERANCE près (relative, absolue sous 1), vectorisée"""
+    return numpy.abs(a - b) <= TOLERANCE * numpy.maximum(1.0, numpy.maximum(numpy.abs(a), numpy.abs(b)))
+
+
+@functools.lru_cache(maxsize=1024)
+def match_wkt(wkt):
+    """Code EPSG (str) d'un WKT1 ESRI ou GDAL, sans réseau :
+       - forme canonique du WKT cherchée par son hash dans l'index, CRS de
+         même nom préféré si plusieurs ont la même définition
+       - sinon CRS de même type, même méthode et même ellipsoïde dont tous
+         les paramètres sont égaux à TOLERANCE près (paramètre absent : 0),
+         datum de même nom préféré
+       Retourne None si aucune correspondance
+    """
+    try:
+        tree = parse_wkt(wkt)
+    except ValueError as e:
+        print("match_wkt() WKT illisible:", e)
         return None
+    canonical = normalize(tree)
+    name = normalize_name(tree[1]) if isinstance(tree[1], str) else ""
+
+    hashes, entries = load_index()
+    candidates = hashes.get(wkt_hash(canonical))
+    if candidates:
+        return min((other_name != name, int(code), code) for other_name, code in candidates)[2]
+
+    sig = signature(canonical)
+    kind, method, axis = group_key(sig)
+    datum, spheroid, parameters = sig[2:]
+    # demi grand axe à TOLERANCE près : groupes des arrondis voisins
+    groups = load_groups()
+    neighbours = [axis] if axis is None else [axis - 1, axis, axis + 1]
+    matches = []
+    for neighbour in neighbours:
+        if (kind, method, neighbour) not in groups:
+            continue
+        codes, datums, spheroids, names, values = groups[kind, method, neighbour]
+        # paramètre inconnu du groupe : comparé à 0
+        if not all(close(value, 0.0) for parameter, value in parameters.items() if parameter not in names):
+            continue
+        query = numpy.array([parameters.get(parameter, 0.0) for parameter in names])
+        ok = close(spheroids, numpy.array(spheroid_values(spheroid))).all(axis=1)
+        ok &= close(values, query).all(axis=1)
+        for i in numpy.flatnonzero(ok):
+            matches.append((datums[i] != datum, int(codes[i]), codes[i]))
+    return min(matches)[2] if matches else None
+
+
+def build_index():
+    """Génère INDEX_FILE : forme canonique des WKT ESRI et GDAL de chaque CRS
+       EPSG projeté ou géographique 2D non obsolète. Retourne le nombre de CRS
+    """
+    try:
+        import pyproj
+        from pyproj.database import query_crs_info
+        from pyproj.enums import PJType
+    except ImportError as err_import:
+        print("Erreur à l'import de pyproj (nécessaire pour générer l'index)")
+        print(err_import)
+        sys.exit(1)
+
+    infos = query_crs_info(
+        auth_name="EPSG",
+        pj_types=[PJType.PROJECTED_CRS, PJType.GEOGRAPHIC_2D_CRS],
+        allow_deprecated=False
+    )
+    entries = []
+    for info in sorted(infos, key=lambda info: int(info.code)):
+        crs = pyproj.CRS.from_authority("EPSG", info.code)
+        canonicals = []
+        for version in ("WKT1_ESRI", "WKT1_GDAL"):
+            try:
+                wkt = crs.to_wkt(version)
+            except pyproj.exceptions.CRSError:
+                # CRS sans équivalent dans cette version de WKT
+                continue
+            tree = parse_wkt(wkt)
+            canonical = normalize(tree)
+            if canonical not in canonicals:
+                canonicals.append(canonical)
+                entries.append([info.code, normalize_name(tree[1]), wkt_hash(canonical), canonical])
+
+    with gzip.open(INDEX_FILE, "wt", encoding="utf-8") as index_file:
+        json.dump(entries, index_file, separators=(",", ":"))
+    return len(infos)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
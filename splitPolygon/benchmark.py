@@ -0,0 +1,247 @@
+#!/usr/bin/python3.6
+
+"""
+Benchmark des moteurs de découpe de splitPolygon et splitPolygon_nbpoints
+sur des géometries synthétiques (cas défavorables) :
+- trait de côte fractal
+- polygone troué de milliers de trous
+- bande longue et fine
+- multipolygone de milliers de parties
+
+Pour chaque cas et chaque mode : durée, nombre de polygones, nombre
+d'intersections, pic mémoire et contrôle de la conservation de la surface
+"""
+
+import sys
+import json
+import math
+import time
+import resource
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from shapely.geometry import Point, LineString
+
+from splitPolygon import *
+import splitPolygon_nbpoints as nbpoints
+
+
+def fractalCoastline(echelle=1, seed=1):
+    """Polygone étoilé dont le rayon suit un bruit fractal (somme d'octaves)"""
+    rng = numpy.random.default_rng(seed)
+    n = 20000 * echelle
+    theta = numpy.linspace(0, 2 * math.pi, n, endpoint=False)
+    radius = numpy.ones(n)
+    for octave in range(1, 12):
+        frequency = 2 ** octave
+        radius += 0.5 ** (octave / 1.5) * numpy.sin(
+            frequency * theta + rng.uniform(0, 2 * math.pi)
+        ) * 0.3
+    radius *= 20000
+    return Polygon(numpy.column_stack((radius * numpy.cos(theta), radius * numpy.sin(theta))))
+
+
+def holes(echelle=1):
+    """Carré de 20 km percé d'une grille de trous circulaires"""
+    n = int(60 * math.sqrt(echelle))
+    step = 20000 / n
+    centers = (numpy.arange(n) + 0.5) * step
+    trous = [
+        Point(x, y).buffer(step / 4, 4).exterior.coords
+        for x in centers for y in centers
+    ]
+    return Polygon([(0, 0), (20000, 0), (20000, 20000), (0, 20000)], trous)
+
+
+def thinStrip(echelle=1):
+    """Bande sinueuse de 100 km de long et 50 m de large"""
+    x = numpy.linspace(0, 100000 * echelle, 5000 * echelle)
+    y = 2000 * numpy.sin(x / 3000)
+    return LineString(numpy.column_stack((x, y))).buffer(25)
+
+
+def hugeMultipolygon(echelle=1, seed=2):
+    """Multipolygone de milliers de petites parties disjointes"""
+    rng = numpy.random.default_rng(seed)
+    n = int(70 * math.sqrt(echelle))
+    step = 1000
+    parts = [
+        Point(i * step + rng.uniform(-200, 200), j * step + rng.uniform(-200, 200)).buffer(
+            rng.uniform(100, 250), 8
+        )
+        for i in range(n) for j in range(n)
+    ]
+    return MultiPolygon(parts)
+
+
+CASES = {
+    'fractal': fractalCoastline,
+    'trous': holes,
+    'bande': thinStrip,
+    'multipolygone': hugeMultipolygon,
+}
+
+
+def _recursive(geom, surface_max, points_max, stats):
+    polygons = []
+    splitPolygon(geom, surface_max, polygons)
+    return polygons
+
+
+def _iterative(coupe, clip):
+    def split(geom, surface_max, points_max, stats):
+        return list(splitPolygonIter(geom, surface_max, coupe, stats, clip))
+    return split
+
+
+def _multi(clip):
+    def split(geom, surface_max, points_max, stats):
+        return list(splitPolygonIter(
+            geom, surface_max, stats=stats, clip=clip, criteres={'nb_points': points_max}
+        ))
+    return split
+
+
+def _levels(geom, surface_max, points_max, stats):
+    return [
+        polygon for polygons in splitPolygonsLevels([geom], surface_max, stats)
+        for polygon in polygons
+    ]
+
+
+def _voronoi(geom, surface_max, points_max, stats):
+    return list(splitPolygonVoronoi(geom, surface_max, stats))
+
+
+def _grid(geom, surface_max, points_max, stats):
+    # cellule carrée de surface surface_max
+    return list(gridTiles([geom], math.sqrt(surface_max * 10000), stats))
+
+
+def _nbpoints(clip, coupe='milieu'):
+    def split(geom, surface_max, points_max, stats):
+        polygons = []
+        nbpoints.split_polygon(
+            geom, "nb_points", points_max, polygons, clip=clip, stats=stats, coupe=coupe
+        )
+        return polygons
+    return split
+
+
+# mode -> fonction(geom, surface max en ha, nombre de points max, stats)
+MODES = {
+    'recursif': _recursive,
+    'iter/milieu/overlay': _iterative('milieu', 'overlay'),
+    'iter/milieu/rect': _iterative('milieu', 'rect'),
+    'iter/aire/overlay': _iterative('aire', 'overlay'),
+    'iter/aire/rect': _iterative('aire', 'rect'),
+    'iter/cout/rect': _iterative('cout', 'rect'),
+    'nbpoints/overlay': _nbpoints('overlay'),
+    'nbpoints/rect': _nbpoints('rect'),
+    'nbpoints/sommets/rect': _nbpoints('rect', 'sommets'),
+    'multi/surface+points/rect': _multi('rect'),
+    'niveaux': _levels,
+    'voronoi': _voronoi,
+    'grille': _grid,
+}
+
+
+def runMode(mode, wkb, surface_max, points_max):
+    """Exécuté dans un processus neuf : découpe et mesures d'un mode.
+       Le pic mémoire est l'augmentation de ru_maxrss (ko) pendant la découpe
+    """
+    geom = shapely.wkb.loads(wkb)
+    stats = {}
+    rss_debut = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    debut = time.perf_counter()
+    try:
+        polygons = MODES[mode](geom, surface_max, points_max, stats)
+    except RecursionError:
+        return {'mode': mode, 'erreur': 'RecursionError'}
+    duree = time.perf_counter() - debut
+    rss_fin = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    surface = sum(polygon.area for polygon in polygons)
+    return {
+        'mode': mode,
+        'duree': duree,
+        'polygones': len(polygons),
+        'intersections': stats.get('intersections'),
+        'sommets_ajoutes': (
+            stats['sommets_sortie'] - stats['sommets_entree']
+            if 'sommets_entree' in stats else None
+        ),
+        'memoire_ko': rss_fin - rss_debut,
+        'ecart_surface': abs(surface - geom.area) / geom.area,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark des moteurs de découpe sur des géometries synthétiques'
+    )
+    parser.add_argument('--cas', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--echelle', type=int, default=1, help='facteur de taille des cas')
+    parser.add_argument(
+        '--pieces',
+        type=int,
+        default=128,
+        help='nombre de polygones visé : fixe la surface et le nombre de points max'
+    )
+    parser.add_argument('--sortie', help='fichier JSON lines des résultats')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=1e-9,
+        help='écart relatif de surface toléré entre entrée et sortie'
+    )
+    args = parser.parse_args()
+
+    results = []
+    surface_ok = True
+    context = multiprocessing.get_context('fork')
+    for cas in args.cas:
+        geom = CASES[cas](args.echelle)
+        surface_max = geom.area / 10000 / args.pieces
+        points_max = max(100, int(shapely.get_num_coordinates(geom)) // args.pieces)
+        print("{0}: {1} points, {2:.0f} ha, surface max {3:.2f} ha, points max {4}".format(
+            cas, shapely.get_num_coordinates(geom), geom.area / 10000, surface_max, points_max
+        ))
+
+        for mode in args.modes:
+            # un processus par mesure pour isoler le pic mémoire
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    runMode, mode, geom.wkb, surface_max, points_max
+                ).result()
+            result['cas'] = cas
+            results.append(result)
+
+            if 'erreur' in result:
+                print("  {0:<26} {1}".format(mode, result['erreur']))
+                continue
+            ok = result['ecart_surface'] <= args.tolerance
+            surface_ok = surface_ok and ok
+            print("  {0:<26} {1:8.3f} s {2:7} polygones {3:>8} intersections "
+                  "{4:>8} sommets ajoutés {5:8} ko  surface {6}".format(
+                      mode, result['duree'], result['polygones'],
+                      '-' if result['intersections'] is None else result['intersections'],
+                      '-' if result['sommets_ajoutes'] is None else result['sommets_ajoutes'],
+                      result['memoire_ko'], 'OK' if ok else 'ECART %.2e' % result['ecart_surface']
+                  ))
+
+    if args.sortie is not None:
+        with open(args.sortie, 'w') as output:
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+
+    if not surface_ok:
+        print("Surface non conservée pour au moins un mode")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,16 @@
 
 import os
 import sys
+import math
+import time
 import logging
 import argparse
+import itertools
+import json
+import hashlib
+import sqlite3
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import fiona
@@ -12,8 +20,21 @@ except ImportError:
     print('ImportError fiona')
     sys.exit(1)
 
+try:
+    import numpy
+except ImportError:
+    print('ImportError numpy')
+    sys.exit(1)
+
+try:
+    from pyproj import CRS, Transformer
+except ImportError:
+    print('ImportError pyproj')
+    sys.exit(1)
+
 try:
     from shapely import *
+    import shapely.wkb
     from shapely.wkt import loads, dumps
     from shapely.geometry import box, Polygon, MultiPolygon, shape, mapping
     from shapely.ops import linemerge, unary_union, polygonize
@@ -21,45 +42,177 @@ except ImportError:
     print('ImportError shapely')
     sys.exit(1)
 
+# nombre maximal de coupes successives d'un morceau : chaque côté de sa
+# bbox est alors divisé par 2**32, bien en deçà de la précision des données
+PROFONDEUR_MAX = 64
+
+
+def getSourceEpsg(source, epsg):
+    """Retourne l'epsg source de la collection fiona source,
+       ou epsg (passé avec -epsg) si aucun .prj n'est détecté
+    """
+    if len(source.crs) > 0:
+        source_epsg = source.crs
+    elif epsg is not None:
+        source_epsg = {'init': 'epsg:' + epsg}
+    else:
+        print("Aucun fichier prj détecté et/ou aucune projection source passée avec -epsg")
+        sys.exit(1)
+
+    if source_epsg['init'] == 'epsg:4326':
+        print("Le SHP d'origne doit être dans une projection en mètre")
+        print("détecté:", source_epsg)
+        sys.exit(1)
+
+    return source_epsg
+
+
+def iterGeomBatches(inputfn, batch_size=1000):
+    """Générateur des géometries de inputfn par lots de batch_size :
+       (liste des clés fiona, tableau numpy des géometries)
+    """
+    with fiona.Env():
+        with fiona.open(inputfn) as source:
+            items = source.items()
+            while True:
+                batch = list(itertools.islice(items, batch_size))
+                if not batch:
+                    break
+                keys = [key for key, value in batch]
+                geoms = numpy.array(
+                    [shape(value["geometry"]) for key, value in batch], dtype=object
+                )
+                yield keys, geoms
+
+
+def checkValidity(geoms):
+    """Validité d'un tableau de géometries en un seul appel vectorisé.
+       Retourne la liste des (indice, raison) des géometries invalides
+    """
+    invalid = numpy.flatnonzero(~shapely.is_valid(geoms))
+    if len(invalid) == 0:
+        return []
+    reasons = shapely.is_valid_reason(geoms[invalid])
+    return list(zip(invalid.tolist(), reasons))
+
+
+def keepPolygonal(geoms):
+    """Ne conserve que les parties surfaciques des GeometryCollection
+       d'un tableau de géometries (modifié en place et renvoyé). Les
+       points et lignes seuls (coupe le long d'un côté) deviennent vides
+    """
+    types = shapely.get_type_id(geoms)
+    collections = numpy.flatnonzero(types == shapely.GeometryType.GEOMETRYCOLLECTION)
+    for i in collections:
+        geoms[i] = unary_union([
+            part for part in geoms[i].geoms
+            if part.geom_type in ('Polygon', 'MultiPolygon')
+        ])
+    autres = ~numpy.isin(types, (
+        shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON,
+        shapely.GeometryType.GEOMETRYCOLLECTION, shapely.GeometryType.MISSING
+    ))
+    geoms[autres] = shapely.Polygon()
+    return geoms
+
+
+def repairGeoms(geoms):
+    """make_valid sur tout un tableau de géometries. Seules les parties
+       surfaciques des GeometryCollection produites sont conservées
+    """
+    return keepPolygonal(shapely.make_valid(geoms))
+
+
+def iterGeom(inputfn, repair=False):
+    """Générateur des géometries de inputfn, lues par lots et renvoyées
+       une à une. Si repair, les géometries invalides passent par repairGeoms()
+    """
+    for keys, geoms in iterGeomBatches(inputfn):
+        if repair:
+            invalid = [i for i, reason in checkValidity(geoms)]
+            if invalid:
+                geoms[invalid] = repairGeoms(geoms[invalid])
+        yield from geoms
+
 
-def getGeom(inputfn, epsg):
-    """Retourne:
-       - géometrie de inputfn
-       - booleen à True si toutes les geom sont valides
+def checkGeom(inputfn, epsg):
+    """Parcours de inputfn sans conserver les géometries. Retourne:
+       - liste des (clé fiona, raison) des géometries invalides
        - l'epsg source s'il a pu être détecté
     """
-    print("Récupération des géometries")
-    polygonGeoms = []
-    all_valid = True
     with fiona.Env():
         with fiona.open(inputfn) as source:
-            if len(source.crs) > 0:
-                source_epsg = source.crs
-            elif epsg is not None:
-                source_epsg = {'init': 'epsg:' + epsg}
-            else:
-                print("Aucun fichier prj détecté et/ou aucune projection source passée avec -epsg")
-                sys.exit(1)
+            source_epsg = getSourceEpsg(source, epsg)
 
-            if source_epsg['init'] == 'epsg:4326':
-                print("Le SHP d'origne doit être dans une projection en mètre")
-                print("détecté:", source_epsg)
-                sys.exit(1)
+    invalids = []
+    for keys, geoms in iterGeomBatches(inputfn):
+        invalids.extend((keys[i], reason) for i, reason in checkValidity(geoms))
+    return invalids, source_epsg
 
-            items = source.items()
-            for key, value in items:
-                geom = shape(value["geometry"])
-                if not geom.is_valid:
-                    all_valid = False
-                polygonGeoms.append(geom)
 
-            return polygonGeoms, all_valid, source_epsg
+def getTransformer(source_epsg):
+    """Transformer pyproj de source_epsg (crs fiona ou {'init': 'epsg:XXXX'})
+       vers l'EPSG:4326, créé une seule fois pour tout le traitement
+    """
+    if hasattr(source_epsg, 'to_wkt'):
+        source_crs = CRS.from_wkt(source_epsg.to_wkt())
+    elif 'init' in source_epsg:
+        source_crs = CRS.from_user_input(source_epsg['init'])
+    else:
+        source_crs = CRS.from_dict(source_epsg)
+    return Transformer.from_crs(source_crs, "EPSG:4326", always_xy=True)
+
 
+def reprojectPolygons(transformer, polygons):
+    """Reprojette un lot de polygones avec un seul appel vectorisé
+       au transformer sur l'ensemble de leurs coordonnées
+    """
+    def transformCoords(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return numpy.column_stack((x, y))
+
+    return list(shapely.transform(numpy.array(polygons, dtype=object), transformCoords))
+
+
+def _writeGeojson(filename, polygonId, geom):
+    """Ecriture d'un GeoJSON contenant un seul polygone"""
+    with open(filename, 'w') as output:
+        json.dump({
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'properties': {
+                    'polygoneid': polygonId
+                },
+                'geometry': mapping(geom)
+            }]
+        }, output)
 
-def debug_dumpPoligons(polygons, inputfn, source_epsg):
+
+def iterBatches(polygons, batch_size):
+    """Générateur des polygones par lots de batch_size. Seul le lot en
+       cours est en mémoire : les polygones produits par la découpe ne sont
+       jamais tous conservés, quel que soit leur nombre
+    """
+    polygons = iter(polygons)
+    while True:
+        batch = list(itertools.islice(polygons, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def debug_dumpPoligons(polygons, inputfn, source_epsg, output_format='gpkg',
+                       batch_size=1000, threads=4):
     """Créé dans un nouveau dossier du même nom que le SHP d'entrée
-       un nouveau SHP résultat de la découpe et autant de GeoJSON
-       en EPSG:4326 que d'entitées créés
+       un nouveau SHP résultat de la découpe et les polygones en EPSG:4326 :
+       - output_format 'gpkg' : un seul GeoPackage
+       - output_format 'geojsonl' : un seul GeoJSON (une entité par ligne)
+       - output_format 'geojson' : autant de GeoJSON que d'entitées créés,
+         écrits par un pool de threads threads
+       polygons est parcouru une seule fois par lots de batch_size : chaque
+       lot est écrit et reprojeté (un seul appel au transformer) dès qu'il
+       est complet si polygons est un générateur
     """
     schema = {
         'geometry': 'Polygon',
@@ -67,6 +220,8 @@ def debug_dumpPoligons(polygons, inputfn, source_epsg):
             'polygoneid': 'int',
         }
     }
+    # GPKG et GeoJSONSeq refusent un MultiPolygon dans une couche Polygon
+    schema_wgs84 = dict(schema, geometry='MultiPolygon')
 
     output_dir = './SPLITTED_' +  os.path.splitext(inputfn)[0]
     if not os.path.exists(output_dir):
@@ -74,60 +229,204 @@ def debug_dumpPoligons(polygons, inputfn, source_epsg):
 
     print("Ecriture des fichiers dans", output_dir)
 
-    i = 0
-    with fiona.collection(
-        output_dir + '/SPLITTED_' + inputfn, 
-        'w', 'ESRI Shapefile', schema
-    ) as output:
-        for polygon in polygons:
-            output.write({
-                'properties': {
-                    'polygoneid': i
-                },
-                'geometry': mapping(polygon)
-            })
-            i += 1
+    transformer = getTransformer(source_epsg)
+
+    if output_format == 'gpkg':
+        output_wgs84 = fiona.open(
+            output_dir + '/SPLITTED_' + os.path.splitext(inputfn)[0] + '_4326.gpkg',
+            'w', 'GPKG', schema_wgs84, crs='EPSG:4326'
+        )
+    elif output_format == 'geojsonl':
+        output_wgs84 = fiona.open(
+            output_dir + '/SPLITTED_' + os.path.splitext(inputfn)[0] + '_4326.geojsonl',
+            'w', 'GeoJSONSeq', schema_wgs84, crs='EPSG:4326'
+        )
+    else:
+        output_wgs84 = None
+        pool = ThreadPoolExecutor(threads)
 
     i = 0
-    for polygon in polygons:
-        geom_transform = transform_geom(source_epsg, "EPSG:4326", mapping(polygon))
+    try:
         with fiona.collection(
-            output_dir + '/' + str(i) + '.geojson', 
-            'w', 'GeoJSON', schema
+            output_dir + '/SPLITTED_' + inputfn, 
+            'w', 'ESRI Shapefile', schema
         ) as output:
-            output.write({
-                'properties': {
-                    'polygoneid': i
-                },
-                'geometry': geom_transform
-            })
-            i += 1
+            for batch in iterBatches(polygons, batch_size):
+                output.writerecords([{
+                    'properties': {
+                        'polygoneid': i + n
+                    },
+                    'geometry': mapping(polygon)
+                } for n, polygon in enumerate(batch)])
+
+                batch_transform = reprojectPolygons(transformer, batch)
+                if output_wgs84 is not None:
+                    output_wgs84.writerecords([{
+                        'properties': {
+                            'polygoneid': i + n
+                        },
+                        'geometry': mapping(
+                            MultiPolygon([geom_transform])
+                            if geom_transform.geom_type == 'Polygon' else geom_transform
+                        )
+                    } for n, geom_transform in enumerate(batch_transform)])
+                else:
+                    # list() pour remonter les erreurs d'écriture des threads
+                    list(pool.map(
+                        _writeGeojson,
+                        [output_dir + '/' + str(i + n) + '.geojson' for n in range(len(batch))],
+                        range(i, i + len(batch)),
+                        batch_transform
+                    ))
 
-    print(i, "fichiers GeoJSON créés")
+                i += len(batch)
+    finally:
+        if output_wgs84 is not None:
+            output_wgs84.close()
+        else:
+            pool.shutdown()
 
+    if output_format == 'geojson':
+        print(i, "fichiers GeoJSON créés")
+    else:
+        print(i, "polygones écrits en EPSG:4326")
 
-def splitPolygon(geom, maxsurface, targetListVar):
+
+def countStat(stats, key, n=1):
+    """Incrémente le compteur key du dict stats (si stats n'est pas None)"""
+    if stats is not None:
+        stats[key] = stats.get(key, 0) + n
+
+
+def areaMedian(geom, vertical, stats=None, iterations=16, tolerance=0.01):
+    """Position de la droite sécante (x si vertical, sinon y) qui partage geom
+       en deux parties de même surface, trouvée par dichotomie
+       - chaque sondage est un clip_by_rect, bien moins coûteux qu'une intersection
+       - arrêt dès que la surface d'un côté est à tolerance près de la moitié
+       - le rectangle de sondage déborde de la bbox sauf sur la droite
+         sécante, comme dans cutRects()
     """
-    polygone en entrée
-    calcul de sa bbox
-    calcul de son orientation
-    calcul des points A et B de la droite séquante
-    création de la géometrie Line
-    création des deux "boites" de part et d'autre de la bbox
-    création des polygones par intersection entre chaque boite et la geom
+    xmin, ymin, xmax, ymax = geom.bounds
+    low, high = (xmin, xmax) if vertical else (ymin, ymax)
+    target = geom.area / 2
+    marge = max(xmax - xmin, ymax - ymin)
+
+    cut = (low + high) / 2
+    for _ in range(iterations):
+        cut = (low + high) / 2
+        if vertical:
+            area = shapely.clip_by_rect(
+                geom, xmin - marge, ymin - marge, cut, ymax + marge
+            ).area
+        else:
+            area = shapely.clip_by_rect(
+                geom, xmin - marge, ymin - marge, xmax + marge, cut
+            ).area
+        countStat(stats, 'sondages')
+
+        if abs(area - target) <= tolerance * target:
+            break
+        if area < target:
+            low = cut
+        else:
+            high = cut
+
+    return cut
+
+
+def cheapestCut(geom, stats=None, fractions=(0.3, 0.4, 0.5, 0.6, 0.7)):
+    """Choix de la droite sécante la moins coûteuse parmi quelques
+       positions candidates (fractions de la bbox) sur chaque axe
+       - coût estimé : nombre d'arêtes des anneaux traversées par la droite,
+         chaque traversée créant un sommet dans chaque moitié
+       - le petit côté n'est candidat que s'il fait au moins la moitié du grand
+       - à coût égal, la position la plus proche du milieu l'emporte
+       Retourne (vertical, position)
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    # arêtes de tous les anneaux : sommets consécutifs d'un même anneau
+    coords, ring = shapely.get_coordinates(
+        shapely.get_rings(shapely.get_parts(geom)), return_index=True
+    )
+    same_ring = ring[:-1] == ring[1:]
+    start, end = coords[:-1][same_ring], coords[1:][same_ring]
+    fractions = numpy.array(fractions)
+
+    axes = []
+    if (xmax - xmin) >= (ymax - ymin) / 2:
+        axes.append((True, xmin + fractions * (xmax - xmin), 0))
+    if (ymax - ymin) >= (xmax - xmin) / 2:
+        axes.append((False, ymin + fractions * (ymax - ymin), 1))
+
+    best = None
+    for vertical, candidates, axis in axes:
+        crossings = (
+            (start[:, axis, None] < candidates) != (end[:, axis, None] < candidates)
+        ).sum(axis=0)
+        for fraction, cut, n in zip(fractions, candidates, crossings):
+            score = (n, abs(fraction - 0.5))
+            if best is None or score < best[0]:
+                best = (score, vertical, cut)
+    countStat(stats, 'candidats', len(fractions) * len(axes))
+
+    return best[1], best[2]
+
+
+def cutPosition(geom, coupe='milieu', stats=None):
+    """Retourne (vertical, position) de la droite sécante coupant
+       le plus grand côté de la bbox de geom :
+       - coupe 'milieu' : au milieu de la bbox
+       - coupe 'aire' : à la médiane de surface (voir areaMedian())
+       - coupe 'cout' : position et axe qui créent le moins de sommets
+         (voir cheapestCut())
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    vertical = (xmax - xmin) > (ymax - ymin)
+
+    if coupe == 'cout':
+        return cheapestCut(geom, stats)
+    if coupe == 'aire':
+        cut = areaMedian(geom, vertical, stats)
+    elif vertical:
+        cut = (xmin + xmax) / 2
+    else:
+        cut = (ymin + ymax) / 2
+
+    return vertical, cut
+
+
+def cutRects(geom, coupe='milieu', stats=None):
+    """Retourne les deux rectangles (xmin, ymin, xmax, ymax) de part et
+       d'autre de la droite sécante, dans le même ordre que cutBoxes()
+       Hors droite sécante, les rectangles débordent de la bbox : un côté
+       confondu avec une ancienne coupe donne sinon des anneaux invalides
+       avec clip_by_rect
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    vertical, cut = cutPosition(geom, coupe, stats)
+    marge = max(xmax - xmin, ymax - ymin)
+    xmin, ymin, xmax, ymax = xmin - marge, ymin - marge, xmax + marge, ymax + marge
+
+    if vertical:
+        return (xmin, ymin, cut, ymax), (cut, ymin, xmax, ymax)
+    return (xmin, ymin, xmax, cut), (xmin, cut, xmax, ymax)
+
+
+def cutBoxes(geom, coupe='milieu', stats=None):
+    """Retourne les deux "boites" de part et d'autre de la droite sécante
+       (voir cutPosition())
     """
     # bbox
     xmin, ymin, xmax, ymax = geom.bounds
+    vertical, cut = cutPosition(geom, coupe, stats)
 
     # construction de la droite sécante
-    if (xmax - xmin) > (ymax - ymin):
-        A_x = (xmin + xmax) / 2
+    if vertical:
+        A_x = cut
         A_y = ymax
-        B_x = (xmin + xmax) / 2
+        B_x = cut
         B_y = ymin
 
-        line = loads('LINESTRING ({0} {1}, {2} {3})'.format(A_x, A_y, B_x, B_y))
-
          # box's
         box1 = loads('POLYGON (({0} {1},{2} {3},{4} {5},{6} {7},{0} {1}))'.format(
             xmin, ymin, xmin, ymax, A_x, A_y, B_x, B_y, xmin, ymin
@@ -135,13 +434,11 @@ def splitPolygon(geom, maxsurface, targetListVar):
         box2 = loads('POLYGON (({0} {1},{2} {3},{4} {5},{6} {7},{0} {1}))'.format(
             A_x, A_y, xmax, ymax, xmax, ymin, B_x, B_y, A_x, A_y
         ))
-    elif (xmax - xmin) < (ymax - ymin):
+    else:
         A_x = xmin
-        A_y = (ymin + ymax) / 2
+        A_y = cut
         B_x = xmax
-        B_y = (ymin + ymax) / 2
-
-        line = loads('LINESTRING ({0} {1}, {2} {3})'.format(A_x, A_y, B_x, B_y))
+        B_y = cut
 
         box1 = loads('POLYGON (({0} {1},{2} {3},{4} {5},{6} {7},{0} {1}))'.format(
             xmin, ymin, A_x, A_y, B_x, B_y, xmax, ymin, xmin, ymin
@@ -150,6 +447,20 @@ def splitPolygon(geom, maxsurface, targetListVar):
             A_x, A_y, xmin, ymax, xmax, ymax, B_x, B_y, A_x, A_y
         ))
 
+    return box1, box2
+
+
+def splitPolygon(geom, maxsurface, targetListVar):
+    """
+    polygone en entrée
+    calcul de sa bbox
+    calcul de son orientation
+    calcul des points A et B de la droite séquante
+    création des deux "boites" de part et d'autre de la bbox
+    création des polygones par intersection entre chaque boite et la geom
+    """
+    box1, box2 = cutBoxes(geom)
+
     # géometries splitées
     polygons = []
     polygons.append(geom.intersection(box1))
@@ -161,3 +472,568 @@ def splitPolygon(geom, maxsurface, targetListVar):
             splitPolygon(polygon, maxsurface, targetListVar)
         else:
             targetListVar.append(polygon)
+
+
+def clipHalves(geom, coupe='milieu', clip='overlay', stats=None):
+    """Découpe geom en deux de part et d'autre de la droite sécante :
+       - clip 'overlay' : intersection générique avec les boites de cutBoxes()
+       - clip 'rect' : clip_by_rect sur les rectangles de cutRects(),
+         sans construction WKT
+    """
+    if clip == 'rect':
+        rect1, rect2 = cutRects(geom, coupe, stats)
+        halves = shapely.clip_by_rect(geom, *rect1), shapely.clip_by_rect(geom, *rect2)
+    else:
+        box1, box2 = cutBoxes(geom, coupe, stats)
+        halves = geom.intersection(box1), geom.intersection(box2)
+    countStat(stats, 'intersections', 2)
+    # une coupe le long d'un côté existant produit des lignes sans surface
+    half1, half2 = keepPolygonal(numpy.array(halves, dtype=object))
+    return half1, half2
+
+
+def respecteCriteres(geom, criteres):
+    """Vrai si geom respecte toutes les limites du dict criteres :
+       - 'surface' : surface maximale en ha
+       - 'nb_points' : nombre maximal de sommets
+       - 'etendue' : plus grand côté maximal de la bbox en m
+    """
+    if 'surface' in criteres and (geom.area / 10000) > criteres['surface']:
+        return False
+    if 'nb_points' in criteres and shapely.get_num_coordinates(geom) > criteres['nb_points']:
+        return False
+    if 'etendue' in criteres:
+        xmin, ymin, xmax, ymax = geom.bounds
+        if max(xmax - xmin, ymax - ymin) > criteres['etendue']:
+            return False
+    return True
+
+
+def respecteCriteresArray(geoms, criteres):
+    """Comme respecteCriteres(), sur tout un tableau de géometries :
+       retourne le tableau de booléens correspondant
+    """
+    ok = numpy.ones(len(geoms), dtype=bool)
+    if 'surface' in criteres:
+        ok &= (shapely.area(geoms) / 10000) <= criteres['surface']
+    if 'nb_points' in criteres:
+        ok &= shapely.get_num_coordinates(geoms) <= criteres['nb_points']
+    if 'etendue' in criteres:
+        bounds = shapely.bounds(geoms)
+        ok &= numpy.maximum(
+            bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]
+        ) <= criteres['etendue']
+    return ok
+
+
+def cutBoxesArray(geoms):
+    """Boites des deux côtés de la droite sécante (coupe 'milieu') de tout
+       un tableau de géometries, calculées avec numpy sur leurs bbox
+    """
+    xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+    marge = numpy.maximum(xmax - xmin, ymax - ymin)
+    vertical = (xmax - xmin) > (ymax - ymin)
+    cut = numpy.where(vertical, (xmin + xmax) / 2, (ymin + ymax) / 2)
+
+    xmin, ymin, xmax, ymax = xmin - marge, ymin - marge, xmax + marge, ymax + marge
+    box1 = shapely.box(
+        xmin, ymin, numpy.where(vertical, cut, xmax), numpy.where(vertical, ymax, cut)
+    )
+    box2 = shapely.box(
+        numpy.where(vertical, cut, xmin), numpy.where(vertical, ymin, cut), xmax, ymax
+    )
+    return box1, box2
+
+
+def splitPolygonsLevels(geoms, maxsurface, stats=None, criteres=None, batch_size=1000,
+                        profondeur_max=PROFONDEUR_MAX):
+    """Découpe par niveaux : à chaque niveau, tous les morceaux en attente
+       d'un lot de batch_size entités sont dans un tableau de géometries
+       - bbox et boites calculées avec numpy (voir cutBoxesArray())
+       - une seule intersection vectorisée pour tout le niveau
+       - les morceaux qui respectent les critères sont retirés du tableau
+         avant le niveau suivant
+       - renvoie (yield) la liste des polygones de chaque entité, dans l'ordre
+       - maxsurface, criteres, profondeur_max : voir splitPolygonIter()
+       - stats (dict) : compteurs 'intersections', 'niveaux' et 'forcees'
+         incrémentés
+    """
+    limites = dict(criteres or {})
+    if maxsurface is not None:
+        limites['surface'] = maxsurface
+
+    geoms = iter(geoms)
+    while True:
+        batch = list(itertools.islice(geoms, batch_size))
+        if not batch:
+            break
+
+        groups = [[] for geom in batch]
+        pending = numpy.array(batch, dtype=object)
+        origine = numpy.arange(len(batch))
+        niveau = 0
+        while len(pending) > 0:
+            keep = ~shapely.is_empty(pending)
+            pending, origine = pending[keep], origine[keep]
+
+            ok = respecteCriteresArray(pending, limites)
+            if niveau >= profondeur_max and not ok.all():
+                logging.warning(
+                    "Critères non atteints après %d coupes, %d morceaux conservés tels quels",
+                    niveau, int((~ok).sum())
+                )
+                countStat(stats, 'forcees', int((~ok).sum()))
+                ok[:] = True
+            for polygon, i in zip(pending[ok], origine[ok]):
+                groups[i].append(polygon)
+            pending, origine = pending[~ok], origine[~ok]
+            if len(pending) == 0:
+                break
+
+            box1, box2 = cutBoxesArray(pending)
+            pending = keepPolygonal(shapely.intersection(
+                numpy.concatenate((pending, pending)), numpy.concatenate((box1, box2))
+            ))
+            origine = numpy.concatenate((origine, origine))
+            countStat(stats, 'intersections', len(pending))
+            countStat(stats, 'niveaux')
+            niveau += 1
+
+        yield from groups
+
+
+def splitPolygonIter(geom, maxsurface, coupe='milieu', stats=None, clip='overlay',
+                     criteres=None, profondeur_max=PROFONDEUR_MAX):
+    """Découpe geom en polygones de surface <= maxsurface (en ha)
+       - pile de travail explicite au lieu de la récursion : pas de limite
+         de profondeur, seuls les morceaux en attente restent en mémoire
+       - chaque polygone est renvoyé (yield) dès qu'il respecte la surface max
+       - même ordre de sortie que splitPolygon(), mais une géometrie
+         déjà inférieure à maxsurface est renvoyée telle quelle
+       - coupe : placement de la droite sécante, voir cutPosition()
+       - clip : méthode de découpe, voir clipHalves()
+       - stats (dict) : compteurs 'intersections', 'sondages',
+         'sommets_entree' et 'sommets_sortie' (croissance du nombre de
+         sommets due aux coupes) incrémentés, ainsi que ('profondeur', p) :
+         nombre de polygones renvoyés après p coupes successives
+       - criteres (dict) : limites supplémentaires évaluées ensemble sur
+         chaque polygone, voir respecteCriteres(). maxsurface peut être None
+         si seuls ces critères s'appliquent
+       - profondeur_max : un morceau qui ne respecte toujours pas les
+         critères après profondeur_max coupes est renvoyé tel quel avec un
+         avertissement (compteur 'forcees'), pour qu'aucun critère ne
+         bloque le traitement
+    """
+    limites = dict(criteres or {})
+    if maxsurface is not None:
+        limites['surface'] = maxsurface
+
+    countStat(stats, 'sommets_entree', int(shapely.get_num_coordinates(geom)))
+    # (polygone, nombre de coupes qui l'ont produit)
+    pile = [(geom, 0)]
+    while pile:
+        polygon, profondeur = pile.pop()
+        if polygon.is_empty or polygon.area == 0:
+            continue
+        respecte = respecteCriteres(polygon, limites)
+        if not respecte and profondeur >= profondeur_max:
+            logging.warning(
+                "Critères non atteints après %d coupes, morceau conservé tel quel (%s)",
+                profondeur, polygon.representative_point().wkt
+            )
+            countStat(stats, 'forcees')
+        if respecte or profondeur >= profondeur_max:
+            countStat(stats, 'sommets_sortie', int(shapely.get_num_coordinates(polygon)))
+            countStat(stats, ('profondeur', profondeur))
+            yield polygon
+            continue
+
+        half1, half2 = clipHalves(polygon, coupe, clip, stats)
+
+        # half2 empilée en premier pour traiter half1 d'abord
+        pile.append((half2, profondeur + 1))
+        pile.append((half1, profondeur + 1))
+
+
+def samplePoints(geom, n, rng):
+    """n points tirés uniformément à l'intérieur de geom (tirage dans la
+       bbox, seuls les points contenus sont gardés, test vectorisé)
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    shapely.prepare(geom)
+    points = numpy.empty((0, 2))
+    while len(points) < n:
+        candidates = rng.uniform((xmin, ymin), (xmax, ymax), size=(2 * n, 2))
+        inside = shapely.contains_xy(geom, candidates[:, 0], candidates[:, 1])
+        points = numpy.concatenate((points, candidates[inside]))
+    return points[:n]
+
+
+def kmeans(points, k, rng, iterations=20):
+    """Centres de k classes de points (algorithme de Lloyd). Le centre le
+       plus proche de chaque point est donné par un STRtree sur les centres
+    """
+    geoms = shapely.points(points)
+    centers = points[rng.choice(len(points), k, replace=False)]
+    for _ in range(iterations):
+        tree = shapely.STRtree(shapely.points(centers))
+        labels = numpy.empty(len(points), dtype=numpy.int64)
+        point_idx, center_idx = tree.query_nearest(geoms, all_matches=False)
+        labels[point_idx] = center_idx
+
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros((k, 2))
+        numpy.add.at(sums, labels, points)
+        # une classe vide garde son centre
+        moved = counts > 0
+        new_centers = centers.copy()
+        new_centers[moved] = sums[moved] / counts[moved, None]
+        if numpy.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    return centers
+
+
+def splitPolygonVoronoi(geom, maxsurface, stats=None, criteres=None, seed=0,
+                        points_par_piece=50, max_points=100000, marge=1.1):
+    """Partition de geom en une seule fois en pièces compactes :
+       - nombre de pièces k = ceil(marge * surface / maxsurface), marge pour
+         que des cellules de surface presque égale restent sous la limite
+       - k centres par k-means sur des points tirés dans geom
+         (points_par_piece par pièce, max_points au plus)
+       - cellules de Voronoi des centres découpées par geom en un seul
+         appel vectorisé, sauf celles entièrement à l'intérieur
+       - pièces encore hors limites redécoupées par splitPolygonIter()
+       - maxsurface, criteres, stats : voir splitPolygonIter()
+    """
+    limites = dict(criteres or {})
+    if maxsurface is not None:
+        limites['surface'] = maxsurface
+
+    k = 1
+    if maxsurface is not None:
+        k = math.ceil(marge * (geom.area / 10000) / maxsurface)
+    if k < 2 or respecteCriteres(geom, limites):
+        yield from splitPolygonIter(geom, maxsurface, stats=stats, criteres=criteres)
+        return
+
+    countStat(stats, 'sommets_entree', int(shapely.get_num_coordinates(geom)))
+    rng = numpy.random.default_rng(seed)
+    n = max(k, min(k * points_par_piece, max_points))
+    centers = kmeans(samplePoints(geom, n, rng), k, rng)
+    cells = shapely.get_parts(shapely.voronoi_polygons(
+        shapely.multipoints(centers), extend_to=shapely.box(*geom.bounds)
+    ))
+    # seules les cellules qui coupent le contour sont intersectées
+    shapely.prepare(geom)
+    inside = shapely.contains_properly(geom, cells)
+    pieces = cells.copy()
+    pieces[~inside] = keepPolygonal(shapely.intersection(cells[~inside], geom))
+    countStat(stats, 'intersections', int((~inside).sum()))
+
+    for piece in pieces[~shapely.is_empty(pieces)]:
+        if respecteCriteres(piece, limites):
+            countStat(stats, 'sommets_sortie', int(shapely.get_num_coordinates(piece)))
+            countStat(stats, ('profondeur', 1))
+            yield piece
+        else:
+            countStat(stats, 'reprises')
+            # compteurs de la reprise sans ses sommets d'entrée, déjà comptés,
+            # profondeurs décalées de la partition de Voronoi
+            reprise = {}
+            yield from splitPolygonIter(piece, maxsurface, stats=reprise, criteres=criteres)
+            reprise.pop('sommets_entree')
+            for key, n in reprise.items():
+                if isinstance(key, tuple):
+                    key = ('profondeur', key[1] + 1)
+                countStat(stats, key, n)
+
+
+def compareCuts(geoms, maxsurface, clip='overlay'):
+    """Découpe geoms avec chaque placement de la droite sécante, sans rien
+       écrire, et retourne par coupe les compteurs de splitPolygonIter()
+       ainsi que le nombre de polygones produits
+    """
+    results = {
+        coupe: {
+            'intersections': 0, 'sondages': 0, 'polygones': 0,
+            'sommets_entree': 0, 'sommets_sortie': 0
+        }
+        for coupe in ('milieu', 'aire', 'cout')
+    }
+    for geom in geoms:
+        for coupe, stats in results.items():
+            for polygon in splitPolygonIter(geom, maxsurface, coupe, stats, clip):
+                stats['polygones'] += 1
+    return results
+
+
+def compareClips(geoms, maxsurface, coupe='milieu'):
+    """Découpe geoms avec chaque méthode de découpe, sans rien écrire, et
+       retourne par méthode la durée, le nombre de polygones et la surface
+       totale, ainsi que l'écart (surface de la différence symétrique)
+       entre les polygones des deux méthodes
+    """
+    results = {
+        clip: {'duree': 0.0, 'polygones': 0, 'surface': 0.0}
+        for clip in ('overlay', 'rect')
+    }
+    ecart = 0.0
+    for geom in geoms:
+        pieces = {}
+        for clip, stats in results.items():
+            debut = time.perf_counter()
+            pieces[clip] = list(splitPolygonIter(geom, maxsurface, coupe, clip=clip))
+            stats['duree'] += time.perf_counter() - debut
+            stats['polygones'] += len(pieces[clip])
+            stats['surface'] += sum(polygon.area for polygon in pieces[clip])
+        ecart += shapely.symmetric_difference(
+            unary_union(pieces['overlay']), unary_union(pieces['rect'])
+        ).area
+    return results, ecart
+
+
+def _splitWkb(task):
+    """Worker de splitPolygonsParallelGroups(): découpe une géometrie reçue en WKB
+       et renvoie (pid, durée, liste des polygones en WKB, compteurs)
+    """
+    wkb, maxsurface, coupe, clip, criteres = task
+    debut = time.perf_counter()
+    stats = {}
+    pieces = [
+        polygon.wkb
+        for polygon in splitPolygonIter(
+            shapely.wkb.loads(wkb), maxsurface, coupe, stats, clip, criteres
+        )
+    ]
+    return os.getpid(), time.perf_counter() - debut, pieces, stats
+
+
+def splitPolygonsParallelGroups(geoms, maxsurface, jobs, workersStats, chunksize=8,
+                                coupe='milieu', stats=None, clip='overlay', criteres=None,
+                                pool=None):
+    """Découpe les géometries geoms sur jobs processus
+       - les géometries transitent en WKB entre processus
+       - geoms est consommé par lots de jobs * chunksize * 4 entités pour
+         ne pas charger toute la source en mémoire
+       - renvoie (yield) pour chaque entité, dans l'ordre des entités en entrée,
+         la liste de ses polygones
+       - workersStats (dict) est incrémenté par pid du worker avec
+         le nombre d'entités, de polygones produits et le temps de calcul
+       - coupe, stats, clip, criteres : voir splitPolygonIter(). Le temps
+         de calcul des workers est ajouté au compteur 'duree' de stats
+       - pool : multiprocessing.Pool de jobs processus déjà créé, réutilisé
+         d'un appel à l'autre (sinon un pool est créé pour cet appel)
+    """
+    if pool is None:
+        with multiprocessing.Pool(jobs) as pool:
+            yield from splitPolygonsParallelGroups(
+                geoms, maxsurface, jobs, workersStats, chunksize,
+                coupe, stats, clip, criteres, pool
+            )
+        return
+
+    geoms = iter(geoms)
+    while True:
+        tasks = [
+            (geom.wkb, maxsurface, coupe, clip, criteres)
+            for geom in itertools.islice(geoms, jobs * chunksize * 4)
+        ]
+        if not tasks:
+            break
+        for pid, duree, pieces, worker_stats in pool.imap(_splitWkb, tasks, chunksize):
+            workerStats = workersStats.setdefault(
+                pid, {'entites': 0, 'polygones': 0, 'duree': 0.0}
+            )
+            workerStats['entites'] += 1
+            workerStats['polygones'] += len(pieces)
+            workerStats['duree'] += duree
+            countStat(stats, 'duree', duree)
+            for key, n in worker_stats.items():
+                countStat(stats, key, n)
+            yield [shapely.wkb.loads(piece) for piece in pieces]
+
+
+def openCache(cachefn):
+    """Ouvre (ou crée) le cache sqlite des découpes précédentes :
+       - table entites : clé de chaque entité découpée et son nombre de polygones
+       - table polygones : polygones en WKB de chaque clé, dans l'ordre
+       - table vues : pour chaque clé et chaque configuration (source et
+         paramètres de découpe, voir cacheConfig()), le numéro du dernier
+         passage qui l'a vue
+    """
+    cache = sqlite3.connect(cachefn)
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS entites (cle TEXT PRIMARY KEY, nb INTEGER)'
+    )
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS polygones (cle TEXT, rang INTEGER, wkb BLOB, '
+        'PRIMARY KEY (cle, rang))'
+    )
+    cache.execute(
+        'CREATE TABLE IF NOT EXISTS vues (cle TEXT, config TEXT, vu INTEGER, '
+        'PRIMARY KEY (cle, config))'
+    )
+    return cache
+
+
+def cacheConfig(source, params):
+    """Identifiant d'une configuration : hash de la source et des paramètres"""
+    return hashlib.sha256(
+        json.dumps([source, params], sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def pruneCache(cache, config, passage):
+    """Supprime du cache les entités que la configuration config n'a pas
+       vues pendant le passage numéro passage (entités modifiées ou
+       supprimées de sa source), sauf si une autre configuration les a vues.
+       Les autres configurations ne sont pas touchées. Retourne le nombre
+       d'entités supprimées
+    """
+    perimees = [
+        (cle,) for cle, in cache.execute(
+            'SELECT cle FROM vues WHERE config = ? AND vu < ?', (config, passage)
+        )
+    ]
+    cache.execute('DELETE FROM vues WHERE config = ? AND vu < ?', (config, passage))
+    orpheline = 'cle = ? AND NOT EXISTS (SELECT 1 FROM vues WHERE vues.cle = {0}.cle)'
+    cache.executemany(
+        'DELETE FROM polygones WHERE ' + orpheline.format('polygones'), perimees
+    )
+    supprimees = cache.executemany(
+        'DELETE FROM entites WHERE ' + orpheline.format('entites'), perimees
+    ).rowcount
+    cache.commit()
+    return supprimees
+
+
+def cacheKey(geom, params):
+    """Clé de cache : hash du WKB de geom et des paramètres de découpe"""
+    h = hashlib.sha256(geom.wkb)
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def splitPolygonsCached(geoms, splitGroups, cache, params, cacheStats, batch_size=256,
+                        source=None, prune=True):
+    """Découpe incrémentale : seules les entités absentes du cache sont découpées
+       - geoms est traité par lots de batch_size entités
+       - splitGroups(géometries) renvoie pour chaque géometrie, dans l'ordre,
+         ses polygones (même contrat que splitPolygonsParallelGroups())
+       - params (dict) : paramètres de découpe, inclus dans la clé de cache
+       - cacheStats (dict) : compteurs 'hits', 'misses' et 'supprimees'
+         incrémentés
+       - source : identifiant de la donnée source (chemin du fichier)
+       - chaque entité rencontrée est marquée du numéro de ce passage pour
+         la configuration (source, params). Avec prune, une fois geoms
+         entièrement parcouru, les entités de cette configuration que ce
+         passage n'a pas vues sont supprimées (voir pruneCache())
+       - renvoie (yield) la liste des polygones de chaque entité, dans l'ordre
+    """
+    config = cacheConfig(source, params)
+    passage = cache.execute('SELECT COALESCE(MAX(vu), 0) + 1 FROM vues').fetchone()[0]
+    geoms = iter(geoms)
+    while True:
+        batch = list(itertools.islice(geoms, batch_size))
+        if not batch:
+            break
+
+        keys = [cacheKey(geom, params) for geom in batch]
+        hits = {
+            key: nb for key, nb in cache.execute(
+                'SELECT cle, nb FROM entites WHERE cle IN ({0})'.format(
+                    ','.join('?' * len(keys))
+                ), keys
+            )
+        }
+        cache.executemany(
+            'INSERT OR REPLACE INTO vues VALUES (?, ?, ?)',
+            [(key, config, passage) for key in keys]
+        )
+        misses = iter(splitGroups([
+            geom for geom, key in zip(batch, keys) if key not in hits
+        ]))
+
+        for geom, key in zip(batch, keys):
+            if key in hits:
+                countStat(cacheStats, 'hits')
+                yield [
+                    shapely.wkb.loads(wkb) for wkb, in cache.execute(
+                        'SELECT wkb FROM polygones WHERE cle = ? ORDER BY rang', (key,)
+                    )
+                ]
+            else:
+                countStat(cacheStats, 'misses')
+                polygons = list(next(misses))
+                cache.execute(
+                    'INSERT OR REPLACE INTO entites (cle, nb) VALUES (?, ?)',
+                    (key, len(polygons))
+                )
+                cache.executemany(
+                    'INSERT OR REPLACE INTO polygones VALUES (?, ?, ?)',
+                    [(key, rang, polygon.wkb) for rang, polygon in enumerate(polygons)]
+                )
+                yield polygons
+        cache.commit()
+
+    if prune:
+        countStat(cacheStats, 'supprimees', pruneCache(cache, config, passage))
+
+
+def gridCells(geoms, taille):
+    """Cellules de la grille globale de pas taille (en m, alignée sur
+       l'origine du système de coordonnées) couvrant la bbox d'au moins
+       une géometrie de geoms. Retourne (indices (i, j), tableau des cellules)
+    """
+    bounds = shapely.bounds(geoms)
+    cells = set()
+    for xmin, ymin, xmax, ymax in bounds:
+        imin, jmin = math.floor(xmin / taille), math.floor(ymin / taille)
+        imax = max(imin, math.ceil(xmax / taille) - 1)
+        jmax = max(jmin, math.ceil(ymax / taille) - 1)
+        cells.update(itertools.product(range(imin, imax + 1), range(jmin, jmax + 1)))
+
+    indices = numpy.array(sorted(cells), dtype=numpy.int64).reshape(-1, 2)
+    return indices, shapely.box(
+        indices[:, 0] * taille, indices[:, 1] * taille,
+        (indices[:, 0] + 1) * taille, (indices[:, 1] + 1) * taille
+    )
+
+
+def gridTiles(geoms, taille, stats=None, batch_size=1000):
+    """Découpe geoms selon la grille globale de pas taille (en m)
+       - geoms est traité par lots de batch_size entités
+       - un STRtree sur les entités du lot donne en une requête les couples
+         (entité, cellule) qui s'intersectent
+       - cellules entièrement contenues dans l'entité reprises telles quelles,
+         les autres couples sont découpés en un seul appel vectorisé
+       - les polygones sont renvoyés (yield) par entité puis par cellule
+       - stats (dict) : compteurs 'intersections' et 'cellules' incrémentés
+    """
+    geoms = iter(geoms)
+    while True:
+        batch = numpy.array(list(itertools.islice(geoms, batch_size)), dtype=object)
+        if len(batch) == 0:
+            break
+        # géometries vides (polygones dégénérés vidés par --repair) : pas de bbox
+        batch = batch[~shapely.is_empty(batch)]
+        if len(batch) == 0:
+            continue
+
+        indices, cells = gridCells(batch, taille)
+        tree = shapely.STRtree(batch)
+        cell_idx, geom_idx = tree.query(cells, predicate='intersects')
+        order = numpy.lexsort((cell_idx, geom_idx))
+        cell_idx, geom_idx = cell_idx[order], geom_idx[order]
+        countStat(stats, 'cellules', len(cells))
+
+        shapely.prepare(batch)
+        inside = shapely.contains_properly(batch[geom_idx], cells[cell_idx])
+        pieces = cells[cell_idx]
+        clip = ~inside
+        pieces[clip] = shapely.intersection(batch[geom_idx[clip]], cells[cell_idx[clip]])
+        countStat(stats, 'intersections', int(clip.sum()))
+
+        pieces = keepPolygonal(pieces)
+        yield from pieces[shapely.area(pieces) > 0]
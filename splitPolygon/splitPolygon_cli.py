@@ -1,5 +1,7 @@
 #!/usr/bin/python3.6
 
+import heapq
+
 from splitPolygon import *
 
 """
@@ -11,6 +13,146 @@ création de la géometrie Line
 création des polygones par coupe
 """
 
+def getCriteres(args):
+    """Limites en plus de surface_max passées en ligne de commande"""
+    criteres = {}
+    if args.nbpoints is not None:
+        criteres['nb_points'] = args.nbpoints
+    if args.etendue is not None:
+        criteres['etendue'] = args.etendue
+    return criteres
+
+
+def timeSplit(polygons, stats):
+    """Renvoie (yield) les polygones de polygons en ajoutant au compteur
+       'duree' de stats le seul temps passé à les produire
+    """
+    polygons = iter(polygons)
+    while True:
+        debut = time.perf_counter()
+        polygon = next(polygons, None)
+        countStat(stats, 'duree', time.perf_counter() - debut)
+        if polygon is None:
+            return
+        yield polygon
+
+
+def splitGroups(polygonGeom, args, workersStats, stats, pool=None):
+    """Générateur, pour chaque géometrie de polygonGeom, des polygones
+       < surface_max produits selon le mode choisi en ligne de commande.
+       pool : pool de processus réutilisé en mode --jobs. Le temps de
+       découpe de chaque entité est ajouté au compteur 'duree' de stats
+       (par les workers en mode --jobs, voir timeSplit() sinon)
+    """
+    if args.niveaux:
+        yield from splitPolygonsLevels(
+            polygonGeom, int(args.surface_max), stats, getCriteres(args)
+        )
+    elif args.jobs > 1:
+        yield from splitPolygonsParallelGroups(
+            polygonGeom, int(args.surface_max), args.jobs, workersStats,
+            coupe=args.coupe, stats=stats, clip=args.clip, criteres=getCriteres(args),
+            pool=pool
+        )
+    else:
+        for poly in polygonGeom:
+            if args.recursif:
+                polygons = []
+                splitPolygon(poly, int(args.surface_max), polygons)
+                yield polygons
+            elif args.voronoi:
+                yield timeSplit(splitPolygonVoronoi(
+                    poly, int(args.surface_max), stats, getCriteres(args)
+                ), stats)
+            else:
+                yield timeSplit(splitPolygonIter(
+                    poly, int(args.surface_max), args.coupe, stats, args.clip,
+                    getCriteres(args)
+                ), stats)
+
+
+def traceGroups(groups, stats, output, slowest, top=10):
+    """Renvoie (yield) les groupes de polygones de groups en écrivant dans
+       output une ligne JSON par entité : durée, profondeur maximale,
+       intersections, sommets en entrée et en sortie, nombre de polygones.
+       Les compteurs de chaque entité sont la différence de stats avant et
+       après sa découpe. La durée est celle de la découpe seule (compteur
+       'duree', voir splitGroups()), sans la lecture ni le cache : nulle
+       pour une entité reprise du cache. slowest (liste) garde les top
+       entités les plus lentes
+    """
+    groups = iter(groups)
+    for entite in itertools.count():
+        # avant next() : --jobs et --cache découpent l'entité avant de la renvoyer
+        avant = dict(stats)
+        group = next(groups, None)
+        if group is None:
+            break
+        polygons = list(group)
+        diff = {key: n - avant.get(key, 0) for key, n in stats.items()}
+
+        profondeurs = [key[1] for key, n in diff.items() if isinstance(key, tuple) and n]
+        record = {
+            'entite': entite,
+            'duree': diff.get('duree', 0.0),
+            'profondeur': max(profondeurs, default=0),
+            'intersections': diff.get('intersections', 0),
+            'sommets_entree': diff.get('sommets_entree', 0),
+            'sommets_sortie': diff.get('sommets_sortie', 0),
+            'polygones': len(polygons),
+        }
+        output.write(json.dumps(record) + '\n')
+        heapq.heappush(slowest, (record['duree'], entite, record))
+        if len(slowest) > top:
+            heapq.heappop(slowest)
+        yield polygons
+
+
+def splitAll(polygonGeom, args, workersStats, stats, cache=None, cacheStats=None,
+             trace=None):
+    """Générateur des polygones < surface_max produits pour chaque
+       géometrie de polygonGeom. Avec cache, seules les entités nouvelles
+       ou modifiées depuis le dernier passage sont découpées. Avec trace
+       (fichier, liste des plus lentes), voir traceGroups()
+    """
+    if args.grille is not None:
+        yield from gridTiles(polygonGeom, args.grille, stats)
+        return
+
+    pool = None
+    if cache is not None:
+        params = {
+            'surface_max': int(args.surface_max),
+            'recursif': args.recursif,
+            'niveaux': args.niveaux,
+            'voronoi': args.voronoi,
+            'coupe': args.coupe,
+            'clip': args.clip,
+            'criteres': getCriteres(args),
+        }
+        # un seul pool pour les entités à découper de tous les lots, assez
+        # grands pour occuper tous les processus
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+        groups = splitPolygonsCached(
+            polygonGeom,
+            lambda geoms: splitGroups(geoms, args, workersStats, stats, pool),
+            cache, params, cacheStats, batch_size=max(256, args.jobs * 8 * 4),
+            source=os.path.abspath(args.shp)
+        )
+    else:
+        groups = splitGroups(polygonGeom, args, workersStats, stats)
+    if trace is not None:
+        groups = traceGroups(groups, stats, *trace)
+
+    try:
+        for polygons in groups:
+            yield from polygons
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
 def main():
     # afficher tous les niveaux de log de fiona/shapely
     log = logging.getLogger()
@@ -31,28 +173,212 @@ def main():
         action='store_true',
         help='Procéder au découpage même si erreurs de topologie sont détectées'
     )
+    parser.add_argument(
+        '--nbpoints',
+        type=int,
+        help='nombre maximal de sommets par polygone, évalué avec surface_max'
+    )
+    parser.add_argument(
+        '--etendue',
+        type=float,
+        help='plus grand côté maximal de la bbox des polygones (en m), '
+             'évalué avec surface_max'
+    )
+    parser.add_argument(
+        '--grille',
+        type=float,
+        help='Découper selon une grille globale de pas GRILLE (en m, alignée '
+             'sur l\'origine de la projection) au lieu de la bissection. '
+             'surface_max n\'est alors pas utilisée'
+    )
+    parser.add_argument(
+        '--repair',
+        action='store_true',
+        help='Réparer les géometries invalides (make_valid) avant le découpage'
+    )
+    parser.add_argument(
+        '--recursif',
+        action='store_true',
+        help='Utiliser l\'ancien découpage récursif au lieu de la pile de travail'
+    )
+    parser.add_argument(
+        '--niveaux',
+        action='store_true',
+        help='Découpage par niveaux : tous les morceaux d\'un niveau découpés '
+             'en un seul appel vectorisé (coupe milieu, clip overlay)'
+    )
+    parser.add_argument(
+        '--voronoi',
+        action='store_true',
+        help='Partition en une fois en ceil(surface / surface_max) pièces '
+             'compactes (cellules de Voronoi de centres k-means)'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Nombre de processus pour découper les entités en parallèle'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['gpkg', 'geojsonl', 'geojson'],
+        default='gpkg',
+        help='Sortie EPSG:4326 : un GeoPackage, un GeoJSON ligne à ligne '
+             'ou un GeoJSON par polygone (défaut: gpkg)'
+    )
+    parser.add_argument(
+        '--coupe',
+        choices=['milieu', 'aire', 'cout'],
+        default='milieu',
+        help='Placement de la droite sécante : milieu de la bbox, médiane '
+             'de surface ou position créant le moins de sommets (défaut: milieu)'
+    )
+    parser.add_argument(
+        '--clip',
+        choices=['overlay', 'rect'],
+        default='overlay',
+        help='Découpe par intersection générique ou par clipping rectangulaire '
+             '(défaut: overlay)'
+    )
+    parser.add_argument(
+        '--cache',
+        help='Base sqlite des découpes précédentes : seules les entités '
+             'nouvelles ou modifiées sont redécoupées'
+    )
+    parser.add_argument(
+        '--stats',
+        help='Fichier JSON lines des mesures par entité (durée, profondeur, '
+             'intersections, sommets, polygones), entités les plus lentes affichées'
+    )
+    parser.add_argument(
+        '--comparer',
+        choices=['coupe', 'clip'],
+        help='Comparer sans rien écrire les intersections de chaque coupe '
+             'ou la durée et le résultat de chaque méthode de découpe'
+    )
     args = parser.parse_args()
 
-    # geom du polygone à découper, booleen sur la validité topo, epsg source
-    polygonGeom, all_valid, source_epsg = getGeom(args.shp, args.epsg)
+    if args.recursif and (args.nbpoints is not None or args.etendue is not None):
+        print("--nbpoints et --etendue ne sont pas gérés par le découpage récursif")
+        sys.exit(1)
+    if args.niveaux and (args.recursif or args.jobs > 1 or args.grille is not None):
+        print("--niveaux n'est pas compatible avec --recursif, --jobs et --grille")
+        sys.exit(1)
+    if args.voronoi and (args.recursif or args.niveaux or args.jobs > 1
+                         or args.grille is not None):
+        print("--voronoi n'est pas compatible avec --recursif, --niveaux, --jobs et --grille")
+        sys.exit(1)
+    if args.grille is not None and (args.recursif or args.jobs > 1 or args.cache):
+        print("--grille n'est pas compatible avec --recursif, --jobs et --cache")
+        sys.exit(1)
+    if args.stats is not None and (args.recursif or args.niveaux or args.grille is not None):
+        print("--stats n'est pas compatible avec --recursif, --niveaux et --grille")
+        sys.exit(1)
+    # un morceau qui contient un sommet rentrant du polygone garde ce sommet,
+    # les deux points de sortie de ses côtés et jusqu'à 4 coins de sa bbox
+    if args.nbpoints is not None and args.nbpoints < 8:
+        print("--nbpoints doit être au moins 8 (7 sommets et le point de fermeture)")
+        sys.exit(1)
+
+    # géometries invalides (clé, raison), epsg source
+    # (parcours de la source sans conserver les géometries)
+    invalids, source_epsg = checkGeom(args.shp, args.epsg)
+    for key, reason in invalids:
+        print("entité {0} invalide : {1}".format(key, reason))
 
     # on abandonne si des géometries invalides sont trouvées
     # sauf si l'utilisateur force la découpe avec --forceinvalid
-    if not all_valid and not args.forceinvalid:
+    # ou les répare avec --repair
+    if invalids and args.repair:
+        print(len(invalids), "géometries invalides réparées avec make_valid")
+    elif invalids and not args.forceinvalid:
         print("Une ou plusieurs erreurs de topologies trouvées. Abandon.")
         sys.exit(1)
-    elif not all_valid and args.forceinvalid:
+    elif invalids and args.forceinvalid:
         print("Une ou plusieurs erreurs de topologies trouvées. Forçage du découpage.")
 
-    # liste vide pour stocker les polygones < surfaceMax produits
-    goodPolygons = []
+    # comparaison des placements de la droite sécante
+    # ou des méthodes de découpe, sans écriture
+    if args.comparer == 'coupe':
+        results = compareCuts(
+            iterGeom(args.shp, args.repair), int(args.surface_max), args.clip
+        )
+        for coupe, stats in results.items():
+            print("coupe {0}: {1} intersections, {2} sondages, {3} polygones, "
+                  "+{4} sommets".format(
+                      coupe, stats['intersections'], stats['sondages'], stats['polygones'],
+                      stats['sommets_sortie'] - stats['sommets_entree']
+                  ))
+        for coupe in ('aire', 'cout'):
+            print("intersections économisées par la coupe {0} : {1}".format(
+                coupe, results['milieu']['intersections'] - results[coupe]['intersections']
+            ))
+        sys.exit(0)
+    elif args.comparer == 'clip':
+        results, ecart = compareClips(
+            iterGeom(args.shp, args.repair), int(args.surface_max), args.coupe
+        )
+        for clip, stats in results.items():
+            print("clip {0}: {1:.2f} s, {2} polygones, surface {3:.2f} m2".format(
+                clip, stats['duree'], stats['polygones'], stats['surface']
+            ))
+        print("écart entre les résultats : {0:.6f} m2".format(ecart))
+        sys.exit(0)
+
+    # pipeline lecture -> split -> écriture : chaque entité est lue,
+    # découpée puis ses polygones < surfaceMax écrits avant la suivante
+    workersStats = {}
+    stats = {'intersections': 0, 'sondages': 0}
+    cache = openCache(args.cache) if args.cache is not None else None
+    cacheStats = {'hits': 0, 'misses': 0, 'supprimees': 0}
+    statsOutput = open(args.stats, 'w') if args.stats is not None else None
+    slowest = []
+    goodPolygons = splitAll(
+        iterGeom(args.shp, args.repair), args, workersStats, stats, cache, cacheStats,
+        (statsOutput, slowest) if statsOutput is not None else None
+    )
+    debug_dumpPoligons(goodPolygons, args.shp, source_epsg, args.format)
+
+    if cache is not None:
+        cache.close()
+        print("cache : {0} entités réutilisées, {1} découpées, {2} supprimées".format(
+            cacheStats['hits'], cacheStats['misses'], cacheStats['supprimees']
+        ))
+
+    if args.grille is not None:
+        print(stats['intersections'], "intersections,", stats['cellules'], "cellules")
+    elif args.niveaux:
+        print(stats['intersections'], "intersections,", stats.get('niveaux', 0), "niveaux")
+    elif not args.recursif:
+        print(stats['intersections'], "intersections,", stats['sondages'], "sondages")
+        if 'sommets_entree' in stats:
+            print("{0} sommets en entrée, {1} en sortie (+{2})".format(
+                stats['sommets_entree'], stats['sommets_sortie'],
+                stats['sommets_sortie'] - stats['sommets_entree']
+            ))
+    if stats.get('forcees'):
+        print(stats['forcees'], "polygones hors critères conservés après",
+              PROFONDEUR_MAX, "coupes")
 
-    # split des polygones, incrémentation de goodPolygons
-    for poly in polygonGeom:
-        splitPolygon(poly, int(args.surface_max), goodPolygons)
+    # histogramme des profondeurs et entités les plus lentes
+    if statsOutput is not None:
+        statsOutput.close()
+        for key, n in sorted(item for item in stats.items() if isinstance(item[0], tuple)):
+            print("profondeur {0}: {1} polygones".format(key[1], n))
+        print("entités les plus lentes :")
+        for duree, entite, record in sorted(slowest, reverse=True):
+            print("  entité {0}: {1:.3f} s, profondeur {2}, {3} intersections, "
+                  "{4} -> {5} sommets, {6} polygones".format(
+                      entite, duree, record['profondeur'], record['intersections'],
+                      record['sommets_entree'], record['sommets_sortie'], record['polygones']
+                  ))
 
-    # écriture du SHP de sortie avec goodPolygons
-    debug_dumpPoligons(goodPolygons, args.shp, source_epsg)
+    # débit de chaque worker en mode --jobs
+    for pid, stats in sorted(workersStats.items()):
+        print("worker {0}: {1} entités, {2} polygones, {3:.2f} s ({4:.1f} entités/s)".format(
+            pid, stats['entites'], stats['polygones'], stats['duree'],
+            stats['entites'] / stats['duree'] if stats['duree'] > 0 else 0
+        ))
 
     print("Fin du traitement")
 
@@ -1,27 +1,170 @@
 #!/usr/bin/python3.6
 
-import sys
+import math
+import collections
+import time
+import argparse
+import multiprocessing
 
 import fiona
+import numpy
+import shapely
+import shapely.wkb
 from shapely.geometry import shape, mapping, MultiPolygon, box
 from shapely.ops import unary_union
 from shapely.wkt import loads
 
 def main():
-    geom = get_geom(sys.argv[1])
-    xmin, ymin, xmax, ymax = geom.bounds
-    print(nbpoint_count(geom))
-    print(box(xmin, ymin, xmax, ymax))
-
-    polys = []
-    split_polygon(geom, "nb_points", 180000, polys)
-    with open("output.csv", "w") as dest:
-        i = 0
-        for poly in polys:
-            dest.write(str(i) + ";" + str(poly) + "\n")
-            i += 1
-
-def get_geom(inputfn):
+    parser = argparse.ArgumentParser(
+        description='Split un polygone en entités de moins de 180000 points'
+    )
+    parser.add_argument('shp', help='fichier en entrée')
+    parser.add_argument(
+        '--union',
+        choices=['simple', 'tuiles', 'aucune'],
+        default='simple',
+        help='Fusion des entités avant découpage : unary_union unique, '
+             'par tuiles en parallèle, ou aucune (découpage entité par entité)'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Nombre de processus pour la fusion par tuiles'
+    )
+    parser.add_argument(
+        '--format',
+        choices=list(PieceWriter.EXTENSIONS),
+        default='wkt',
+        help='Sortie output.csv en WKT (défaut) ou WKB hexadécimal, '
+             'output.gpkg (GeoPackage) ou output.fgb (FlatGeobuf)'
+    )
+    parser.add_argument(
+        '--clip',
+        choices=['overlay', 'rect'],
+        default='overlay',
+        help='Découpe par intersection générique ou par clipping rectangulaire'
+    )
+    parser.add_argument(
+        '--coupe',
+        choices=['milieu', 'sommets'],
+        default='milieu',
+        help='Droite sécante au milieu de la bbox ou à la médiane des sommets'
+    )
+    parser.add_argument(
+        '--comparer',
+        action='store_true',
+        help='Comparer la profondeur et le nombre de clips de chaque coupe '
+             'sans rien écrire'
+    )
+    args = parser.parse_args()
+
+    if args.union == "aucune":
+        geoms = iter_geom(args.shp)
+    else:
+        geoms = [get_geom(args.shp, args.union == "tuiles", args.jobs)]
+
+    if args.comparer:
+        for geom in geoms:
+            for coupe, stats in compare_cuts(geom, 180000, args.clip).items():
+                print("coupe {0}: profondeur {1}, {2} clips".format(
+                    coupe, stats["profondeur"], stats["intersections"]
+                ))
+        return
+
+    # polygones écrits au fur et à mesure de la découpe, voir PieceWriter
+    with PieceWriter(args.format, get_crs(args.shp)) as polys:
+        for geom in geoms:
+            xmin, ymin, xmax, ymax = geom.bounds
+            nb_points = nbpoint_count(geom)
+            print(nb_points)
+            print(box(xmin, ymin, xmax, ymax))
+
+            debut = time.perf_counter()
+            stats = {"intersections": 0, "profondeur": 0}
+            split_polygon(
+                geom, "nb_points", 180000, polys, nb_points, args.clip, stats, args.coupe
+            )
+            print("découpage ({0}, coupe {1}) : {2:.2f} s, profondeur {3}, {4} clips".format(
+                args.clip, args.coupe, time.perf_counter() - debut,
+                stats["profondeur"], stats["intersections"]
+            ))
+
+    print(polys.count, "polygones écrits dans", polys.filename)
+
+class PieceWriter:
+    """
+       écriture en continu des polygones produits par split_polygon(), qui
+       l'utilise comme une liste (append), avec l'indice de chaque polygone :
+       - "wkt" : csv "indice;WKT" (format historique)
+       - "wkb" : csv "indice;WKB hexadécimal"
+       - "gpkg" : GeoPackage, écrit par transactions de batch_size entités
+       - "fgb" : FlatGeobuf, écrit par lots de batch_size entités
+       au plus batch_size polygones sont en mémoire, quel que soit le nombre
+       de polygones produits
+    """
+    EXTENSIONS = {"wkt": "csv", "wkb": "csv", "gpkg": "gpkg", "fgb": "fgb"}
+    DRIVERS = {"gpkg": "GPKG", "fgb": "FlatGeobuf"}
+    SCHEMA = {"geometry": "MultiPolygon", "properties": {"id": "int"}}
+
+    def __init__(self, format, crs=None, filename=None, batch_size=1000):
+        self.format = format
+        self.filename = filename or "output." + self.EXTENSIONS[format]
+        self.batch_size = batch_size
+        self.count = 0
+        self.batch = []
+        if format in self.DRIVERS:
+            self.dest = fiona.open(
+                self.filename, "w", self.DRIVERS[format], self.SCHEMA, crs=crs
+            )
+        else:
+            self.dest = open(self.filename, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, poly):
+        if self.format == "wkt":
+            self.dest.write(str(self.count) + ";" + str(poly) + "\n")
+        elif self.format == "wkb":
+            self.dest.write(str(self.count) + ";" + poly.wkb_hex + "\n")
+        else:
+            if poly.geom_type != "MultiPolygon":
+                poly = MultiPolygon([poly])
+            self.batch.append({"geometry": mapping(poly), "properties": {"id": self.count}})
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        self.count += 1
+
+    def flush(self):
+        """écriture du lot en cours en une seule transaction"""
+        if self.batch:
+            self.dest.writerecords(self.batch)
+            self.batch = []
+
+    def close(self):
+        if self.format in self.DRIVERS:
+            self.flush()
+        self.dest.close()
+
+def get_crs(inputfn):
+    with fiona.open(inputfn) as src:
+        return src.crs
+
+def iter_geom(inputfn):
+    """géometries de inputfn une à une, sans fusion"""
+    with fiona.open(inputfn) as src:
+        for key, feat in src.items():
+            yield shape(feat["geometry"])
+
+def get_geom(inputfn, tiles=False, jobs=1):
+    """
+       fusion de toutes les entités de inputfn en une seule géometrie
+       tiles : fusion par tuiles en parallèle (voir tiled_union())
+    """
     with fiona.open(inputfn) as src:
         # feat = next(iter(src))
         # return shape(feat["geometry"])
@@ -30,38 +173,94 @@ def get_geom(inputfn):
         for key, feat in src.items():
             polys.append(shape(feat["geometry"]))
 
+        if tiles:
+            return tiled_union(polys, jobs)
         return unary_union(polys)
+
+def _union_wkb(wkbs):
+    """worker de tiled_union() : fusion d'une tuile, en WKB"""
+    return unary_union([shapely.wkb.loads(wkb) for wkb in wkbs]).wkb
+
+def tiled_union(polys, jobs, nb_tiles=64):
+    """
+       fusion en cascade :
+       - répartition des entités sur une grille d'environ nb_tiles tuiles
+         selon le centre de leur bbox
+       - fusion de chaque tuile dans un pool de jobs processus (WKB)
+       - fusion finale des résultats des tuiles
+    """
+    geoms = numpy.array(polys, dtype=object)
+    bounds = shapely.bounds(geoms)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    n = max(1, int(math.sqrt(nb_tiles)))
+    width = (cx.max() - cx.min()) or 1
+    height = (cy.max() - cy.min()) or 1
+    ix = numpy.minimum(((cx - cx.min()) / width * n).astype(int), n - 1)
+    iy = numpy.minimum(((cy - cy.min()) / height * n).astype(int), n - 1)
+    tile = ix * n + iy
+
+    groups = [
+        [geom.wkb for geom in geoms[tile == t]] for t in numpy.unique(tile)
+    ]
+    with multiprocessing.Pool(jobs) as pool:
+        parts = pool.map(_union_wkb, groups, 1)
+
+    return unary_union([shapely.wkb.loads(part) for part in parts])
+
 def nbpoint_count(geom):
     """
        comptage du nombre de points dans le multipolygone
        warning si [150000;180001], arrêt si > 180000
+       lu directement sur les tableaux de coordonnées, sans mapping()
     """
-    coordinates = mapping(geom)["coordinates"]
-    points_count = 0
-    for polygon in coordinates:
-            for part in polygon:
-                points_count += len(part)
+    return int(shapely.get_num_coordinates(geom))
+
+def cut_position(geom, coupe="milieu"):
+    """
+    orientation et position de la droite sécante coupant le plus grand
+    côté de la bbox :
+    - coupe "milieu" : au milieu de la bbox
+    - coupe "sommets" : à la médiane des coordonnées des sommets
+      (numpy.partition), chaque moitié garde environ la moitié des points.
+      la droite passe entre la médiane et la coordonnée suivante pour ne
+      longer aucune arête. milieu de la bbox si la médiane tombe sur un bord
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    vertical = (xmax - xmin) > (ymax - ymin)
+    low, high = (xmin, xmax) if vertical else (ymin, ymax)
 
-    return points_count
+    if coupe == "sommets":
+        coords = shapely.get_coordinates(geom)[:, 0 if vertical else 1]
+        k = len(coords) // 2
+        median = numpy.partition(coords, k)[k]
+        suivantes = coords[coords > median]
+        if len(suivantes) > 0:
+            cut = (median + suivantes.min()) / 2
+            if low < cut < high:
+                return vertical, cut
 
-def split_polygon(geom, critere, criterevalue, target):
+    return vertical, (low + high) / 2
+
+def overlay_halves(geom, coupe="milieu"):
     """
-    polygone en entrée
     calcul de sa bbox
     calcul de son orientation
-    calcul des points A et B de la droite séquante
+    calcul des points A et B de la droite séquante (voir cut_position())
     création de la géometrie Line
     création des deux "boites" de part et d'autre de la bbox
     création des polygones par intersection entre chaque boite et la geom
     """
     # bbox
     xmin, ymin, xmax, ymax = geom.bounds
+    vertical, cut = cut_position(geom, coupe)
 
     # construction de la droite sécante
-    if (xmax - xmin) > (ymax - ymin):
-        A_x = (xmin + xmax) / 2
+    if vertical:
+        A_x = cut
         A_y = ymax
-        B_x = (xmin + xmax) / 2
+        B_x = cut
         B_y = ymin
 
         line = loads('LINESTRING ({0} {1}, {2} {3})'.format(A_x, A_y, B_x, B_y))
@@ -73,11 +272,11 @@ def split_polygon(geom, critere, criterevalue, target):
         box2 = loads('POLYGON (({0} {1},{2} {3},{4} {5},{6} {7},{0} {1}))'.format(
             A_x, A_y, xmax, ymax, xmax, ymin, B_x, B_y, A_x, A_y
         ))
-    elif (xmax - xmin) < (ymax - ymin):
+    else:
         A_x = xmin
-        A_y = (ymin + ymax) / 2
+        A_y = cut
         B_x = xmax
-        B_y = (ymin + ymax) / 2
+        B_y = cut
 
         line = loads('LINESTRING ({0} {1}, {2} {3})'.format(A_x, A_y, B_x, B_y))
 
@@ -88,40 +287,98 @@ def split_polygon(geom, critere, criterevalue, target):
             A_x, A_y, xmin, ymax, xmax, ymax, B_x, B_y, A_x, A_y
         ))
 
-    # géometries splitées
-    polygons = []
-
-    box1_intersect = geom.intersection(box1)
-    box2_intersect = geom.intersection(box2)
-
     # print(box1)
     # print(box2)
     # print(line)
-    # print(box1_intersect)
-    # print(box2_intersect)
-    # sys.exit(0)   
 
+    return geom.intersection(box1), geom.intersection(box2)
 
-    if box1_intersect.geom_type != "MultiPolygon":
-        polygons.append(MultiPolygon([box1_intersect]))
+def rect_halves(geom, coupe="milieu"):
+    """
+    même découpe que overlay_halves() mais par clipping rectangulaire
+    (clip_by_rect) directement sur les coordonnées de la bbox, sans WKT
+    hors droite sécante les rectangles débordent de la bbox : un côté
+    confondu avec une ancienne coupe donne sinon des anneaux invalides
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    marge = max(xmax - xmin, ymax - ymin)
+    vertical, cut = cut_position(geom, coupe)
+
+    if vertical:
+        return (
+            shapely.clip_by_rect(geom, xmin - marge, ymin - marge, cut, ymax + marge),
+            shapely.clip_by_rect(geom, cut, ymin - marge, xmax + marge, ymax + marge)
+        )
     else:
-        polygons.append(box1_intersect)
+        return (
+            shapely.clip_by_rect(geom, xmin - marge, ymin - marge, xmax + marge, cut),
+            shapely.clip_by_rect(geom, xmin - marge, cut, xmax + marge, ymax + marge)
+        )
+
+def split_polygon(geom, critere, criterevalue, target, nb_points=None, clip="overlay",
+                  stats=None, coupe="milieu", profondeur=0):
+    """
+    polygone en entrée
+    découpe en deux moitiés de part et d'autre de la droite sécante
+    (overlay_halves() ou rect_halves() selon clip : "overlay" ou "rect",
+    position selon coupe, voir cut_position())
+    répétition sur chaque moitié qui ne respecte pas le critère
+    nb_points : nombre de points de geom s'il est déjà connu (pas de recomptage)
+    stats (dict) : compteur "intersections" incrémenté, "profondeur" maximale
+    """
+    if critere == "nb_points":
+        if nb_points is None:
+            nb_points = nbpoint_count(geom)
+        if nb_points <= criterevalue:
+            target.append(geom)
+            return
 
-    if box2_intersect.geom_type != "MultiPolygon":
-        polygons.append(MultiPolygon([box2_intersect]))
+    if clip == "rect":
+        halves = rect_halves(geom, coupe)
     else:
-        polygons.append(box2_intersect)
+        halves = overlay_halves(geom, coupe)
+    if stats is not None:
+        stats["intersections"] = stats.get("intersections", 0) + 2
+        stats["profondeur"] = max(stats.get("profondeur", 0), profondeur + 1)
 
-    # print(polygons[0])
-    # print(polygons[1])
+    # géometries splitées
+    polygons = []
+    for half in halves:
+        if half.geom_type == "GeometryCollection":
+            # droite sécante le long d'une arête : on ne garde que les surfaces
+            half = unary_union([
+                part for part in half.geoms
+                if part.geom_type in ("Polygon", "MultiPolygon")
+            ])
+        if half.is_empty:
+            continue
+        if half.geom_type != "MultiPolygon":
+            polygons.append(MultiPolygon([half]))
+        else:
+            polygons.append(half)
 
     if critere == "nb_points":
-        for p in polygons:
-            if nbpoint_count(p) > criterevalue:
-                # print("polygon has", nbpoint_count(p), "points, > at", criterevalue, p)
-                split_polygon(p, "nb_points", criterevalue, target)
-            else:
-                target.append(p)
+        # comptage des deux moitiés en un seul appel, transmis à chaque moitié
+        for p, nb in zip(polygons, shapely.get_num_coordinates(polygons)):
+            split_polygon(
+                p, "nb_points", criterevalue, target, int(nb), clip, stats,
+                coupe, profondeur + 1
+            )
+
+def compare_cuts(geom, criterevalue, clip="overlay"):
+    """
+    découpe geom avec chaque placement de la droite sécante sans rien
+    écrire, retourne par coupe la profondeur et le nombre de clips
+    """
+    results = {}
+    for coupe in ("milieu", "sommets"):
+        stats = {"intersections": 0, "profondeur": 0}
+        split_polygon(
+            geom, "nb_points", criterevalue, collections.deque(maxlen=0),
+            clip=clip, stats=stats, coupe=coupe
+        )
+        results[coupe] = stats
+    return results
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+#!/usr/bin/python3.6
+
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import prj2epsg
+from prj2epsg import Prj2EpsgClient
+
+# 10 CRS, chacun écrit de 20 façons (espaces autour du WKT) : 200 WKT
+CODES = {'PROJCS["crs {0}",GEOGCS["GCS"]]'.format(i): str(2000 + i) for i in range(10)}
+WKTS = [
+    " " * (n % 3) + wkt + "\n" * (n // 3)
+    for n in range(20)
+    for wkt in CODES
+]
+
+
+class Prj2EpsgHandler(BaseHTTPRequestHandler):
+    """Même API que prj2epsg.org/search.json, compte les requêtes reçues"""
+
+    def do_GET(self):
+        wkt = parse_qs(urlparse(self.path).query)["terms"][0]
+        with self.server.lock:
+            self.server.requetes.append(wkt)
+        body = json.dumps({"exact": True, "codes": [{"code": CODES[wkt.strip()]}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrj2EpsgClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Prj2EpsgHandler)
+        self.server.lock = threading.Lock()
+        self.server.requetes = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/search.json".format(self.server.server_port)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cachefn = os.path.join(self.tmpdir.name, "prj2epsg.sqlite")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_une_requete_par_crs(self):
+        with Prj2EpsgClient(self.url, self.cachefn, timeout=5, jobs=4) as client:
+            codes = client.lookup_many(WKTS)
+            self.assertEqual(codes, [CODES[wkt.strip()] for wkt in WKTS])
+            self.assertEqual(len(self.server.requetes), 10)
+            self.assertEqual(client.stats, {"cache": 0, "requetes": 10, "erreurs": 0})
+
+    def test_second_passage_depuis_le_cache(self):
+        with Prj2EpsgClient(self.url, self.cachefn, timeout=5) as client:
+            client.lookup_many(WKTS)
+
+        with Prj2EpsgClient(self.url, self.cachefn, timeout=5) as client:
+            codes = client.lookup_many(WKTS)
+            self.assertEqual(codes, [CODES[wkt.strip()] for wkt in WKTS])
+            self.assertEqual(client.stats, {"cache": 10, "requetes": 0, "erreurs": 0})
+        self.assertEqual(len(self.server.requetes), 10)
+
+    def test_erreurs_non_mises_en_cache(self):
+        # port 1 : connexion refusée
+        with Prj2EpsgClient("http://127.0.0.1:1/search.json", self.cachefn, timeout=1) as client:
+            self.assertIsNone(client.lookup(WKTS[0]))
+            self.assertEqual(client.stats["erreurs"], 1)
+        cache = sqlite3.connect(self.cachefn)
+        self.assertEqual(cache.execute("SELECT COUNT(*) FROM codes").fetchone()[0], 0)
+        cache.close()
+
+        with Prj2EpsgClient(self.url, self.cachefn, timeout=5) as client:
+            self.assertEqual(client.lookup(WKTS[0]), CODES[WKTS[0].strip()])
+            self.assertEqual(client.stats["requetes"], 1)
+        self.assertEqual(len(self.server.requetes), 1)
+
+
+    def test_sans_requests(self):
+        prjfn = os.path.join(self.tmpdir.name, "inconnu.prj")
+        with open(prjfn, "w") as prj:
+            prj.write(WKTS[0])
+        with mock.patch.dict("sys.modules", {"requests": None}):
+            with self.assertRaises(ImportError):
+                Prj2EpsgClient(self.url, self.cachefn)
+            # le client partagé ne peut être créé : None, sans sys.exit()
+            with mock.patch.object(prj2epsg, "_client", None):
+                self.assertIsNone(prj2epsg.prj2epsg(prjfn, online=True))
+
+
+if __name__ == "__main__":
+    unittest.main()